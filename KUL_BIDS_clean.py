@@ -1,127 +1,128 @@
 #!/usr/bin/env python
 
-import glob 
 import os
-import numpy as np
 import json
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import KUL_bids_index
+
+# Get commandline
+parser = argparse.ArgumentParser(description="Keep one T1w, T2w and FLAIR per anat directory of the BIDS directory",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-b', '--bids_dir', default='./BIDS', help='bids directory')
+parser.add_argument('-n', '--ncpu', type=int, default=os.cpu_count(), help='number of subjects cleaned at the same time')
+parser.add_argument('-d', '--dry-run', action='store_true', help='only print what would be kept and removed')
+args = parser.parse_args()
+
+bidsdir = args.bids_dir
+
+
+# a function to decide which image to keep, from the index (json sidecar & nifti header)
+# returns the index of the image to keep and the messages explaining why
+def chooseImage(ImType, Ims):
+    nIms = len(Ims)
+    msg = ['There are ' + str(nIms) + ' ' + ImType + ' images', 'Notably:'] + [Im['path'] for Im in Ims]
+    if ImType == "T2w":
+        # we need to keep the transverse
+        orientation = np.zeros((nIms,3))
+        for i, Im in enumerate(Ims):
+            orientation[i] = Im['ImageOrientationPatientDICOM'][0:3]
+        ori=np.argmax(orientation, axis=1)
+        keep = np.argmin(ori)
+
+    elif ImType == "T1w":
+        # we need to keep the youngest 3D
+        seriesnum = np.array([Im['SeriesNumber'] for Im in Ims], dtype=float)
+        acq = [Im['MRAcquisitionType'] for Im in Ims]
+        if '3D' in acq:
+            candidates = [i for i in range(nIms) if acq[i] == "3D"]
+        else:
+            candidates = list(range(nIms))
+        msn = np.min(seriesnum[candidates]) #minimal seriesnumbr (youngest)
+        keep = [i for i in candidates if seriesnum[i] == msn][0]
+
+    elif ImType == "FLAIR":
+        # we need to keep the highest resolution
+        spacing = np.array([Im['spacing'][0:3] for Im in Ims])
+        msg.append(str(spacing))
+        voxelvolume = np.prod(spacing,axis=1)
+        msg.append(str(voxelvolume))
+        keep=np.argmin(voxelvolume)
+
+    return int(keep), msg
+
+# a function to make the plan of an anat directory: a list of (action, source, target) and messages
+def planAnat(anat_images):
+    plan = []
+    msg = []
+    for ImType in ["T1w", "T2w", "FLAIR"]:
+        Ims = [Im for Im in anat_images if Im['suffix'] == ImType and Im['path'].endswith('.nii.gz')]
+        nIms = len(Ims)
+        if nIms == 0:
+            msg.append('No ' + ImType + ' images, doing nothing')
+            continue
+        elif nIms == 1:
+            msg.append('There is only one ' + ImType + ', keeping this one')
+            continue
+        keep, keep_msg = chooseImage(ImType, Ims)
+        msg += keep_msg
+        msg.append('Keeping ' + Ims[keep]['path'])
+
+        # the others are removed first, so the kept image can take the name of one of them
+        for i, Im in enumerate(Ims):
+            if i != keep:
+                Im_nii = os.path.join(bidsdir, Im['path'])
+                plan.append(('remove', Im_nii, None))
+                plan.append(('remove', KUL_bids_index.getJsonFile(Im_nii), None))
+        Im_nii = os.path.join(bidsdir, Ims[keep]['path'])
+        p1 = Im_nii.split('_run')[0]
+        plan.append(('rename', Im_nii, p1 + '_' + ImType + '.nii.gz'))
+        plan.append(('rename', KUL_bids_index.getJsonFile(Im_nii), p1 + '_' + ImType + '.json'))
+    return plan, msg
+
+# a function to carry out a plan, with in-process (atomic) renames and unlinks
+def applyPlan(plan):
+    for action, source, target in plan:
+        if action == 'remove':
+            if os.path.exists(source):
+                os.unlink(source)
+        elif source != target and os.path.exists(source):
+            os.replace(source, target)
+
+# a function to clean one anat directory, returns what was done (printed by the main thread)
+def cleanAnat(anat_dir, anat_images):
+    plan, msg = planAnat(anat_images)
+    msg = [anat_dir] + msg
+    for action, source, target in plan:
+        if action == 'remove':
+            msg.append('rm -f ' + source)
+        elif source != target:
+            msg.append('mv ' + source + ' ' + target)
+    if not args.dry_run:
+        applyPlan(plan)
+    return msg
+
+
+if not os.path.exists(bidsdir):
+    print(bidsdir + ' does not exist')
+    exit(1)
+
+# read the sidecars & headers of new or changed images, and group the anat images per directory
+KUL_bids_index.updateIndex(bidsdir, args.ncpu)
+anat_dirs = {}
+for Im in KUL_bids_index.query(bidsdir, datatype='anat',
+                               fields=['ImageOrientationPatientDICOM', 'SeriesNumber', 'MRAcquisitionType']):
+    if Im['ImageOrientationPatientDICOM'] is not None:
+        Im['ImageOrientationPatientDICOM'] = json.loads(Im['ImageOrientationPatientDICOM'])
+    anat_dirs.setdefault(os.path.dirname(Im['path']), []).append(Im)
+
+if args.dry_run:
+    print('Dry run, nothing is changed')
+with ThreadPoolExecutor(max_workers=max(1, args.ncpu)) as pool:
+    for msg in pool.map(lambda anat_dir: cleanAnat(anat_dir, anat_dirs[anat_dir]), sorted(anat_dirs)):
+        print('\n'.join(msg))
 
-bidsdir = './BIDS'
-
-for subdir, dirs, files in os.walk(bidsdir):
-    for dir in dirs:
-        if 'anat' in dir:
-            searchdir = os.path.join(subdir, dir)
-            #print(searchdir)
-
-            for ImType in ["T1w", "T2w", "FLAIR"]:
-
-                searchIms = searchdir + '/*' + ImType + '.nii.gz'
-                #print(searchIms)
-
-                # find all Im
-                Ims = glob.glob(searchIms)
-                nIms = len(Ims)
-
-                if nIms == 0:
-                    print('No ' + ImType + ' images, doing nothing')
-                elif nIms == 1:
-                    print('There is only one ' + ImType + ', keeping this one')
-                elif nIms > 1:
-                    if ImType == "T2w":
-                        # we need to keep the transverse
-                        print('There are ' + str(nIms) + ' ' + ImType + ' images')
-                        print ('Notably:')
-                        i=0
-                        orientation = np.zeros((nIms,3))
-                        for Im in Ims:
-                            print(Im)
-                            ImJson = os.path.splitext(os.path.splitext(Im)[0])[0] + '.json'
-                            #print(ImJson)
-                            with open(ImJson, 'r') as myfile:
-                                data=myfile.read()
-                            obj = json.loads(data)
-                            orientationfull = obj['ImageOrientationPatientDICOM']
-                            #print(orientationfull)
-                            orientation[i] = orientationfull[0:3]
-                            i = i + 1 
-                        #print(orientation)
-                        ori=np.argmax(orientation, axis=1)
-                        #print(ori)
-                        keep = np.argmin(ori)
-                        print('Keeping ' + Ims[keep])
-                        
-                    elif ImType == "T1w":
-                        # we need to keep the youngest 3D
-                        print('There are ' + str(nIms) + ' ' + ImType + ' images')
-                        print ('Notably:')
-                        i=0
-                        seriesnum = np.zeros((nIms,1))
-                        acq = []
-                        spacing = np.zeros( (nIms,3))
-                        for Im in Ims:
-                            print(Im)
-                            # read seriesnum
-                            ImJson = os.path.splitext(os.path.splitext(Im)[0])[0] + '.json'
-                            #print(ImJson)
-                            with open(ImJson, 'r') as myfile:
-                                data=myfile.read()
-                            obj = json.loads(data)
-                            seriesnum[i] = obj['SeriesNumber']
-                            # read acquisitiontype
-                            acq.append(obj['MRAcquisitionType'])
-                            i = i + 1 
-                        #print(seriesnum)
-                        #print(acq)
-                        if '3D' in acq:
-                            keep_3D = list(filter(lambda i: acq[i]=="3D", range(len(acq))))
-                            filtered_seriesnum = seriesnum[keep_3D]
-                        else:
-                            filtered_seriesnum = seriesnum
-                        #print(filtered_seriesnum)
-                        msn = np.min(filtered_seriesnum) #minimal seriesnumbr (youngest)
-                        #print(msn)
-                        keep = np.where(seriesnum == msn)
-                        keep = np.asscalar(keep[0])
-                        #print(keep)
-                        print('Keeping ' + Ims[keep])
-                        
-                    elif ImType == "FLAIR":
-                        # we need to keep the highest resolution
-                        keep=0
-                        print('There are ' + str(nIms) + ' ' + ImType + ' images')
-                        spacing = np.zeros( (nIms,3))
-                        print ('Notably:')
-                        i=0
-                        for Im in Ims:
-                            print(Im)
-                            cmd = 'mrinfo ' + Im + ' -spacing'
-                            spacing[i] = os.popen(cmd).read().strip().split()
-                            i = i + 1    
-                        print(spacing)
-                        voxelvolume = np.prod(spacing,axis=1)
-                        print(voxelvolume)
-                        #maxvoxelsize = np.max(spacing, axis=1)
-                        keep=np.argmin(voxelvolume)
-                        print('Keeping ' + Ims[keep])
-
-                    # Now do the change
-                    i = 0
-                    for Im in Ims:
-                        if i == keep:
-                            p1 = Im.split('_run')[0]
-                            #print(p1)
-                            cmd1 = 'mv ' + Im + ' ' + p1 + '_' + ImType + '.nii.gz'
-                            p3 = Im.split('.nii.gz')[0] + '.json'
-                            cmd2 = 'mv ' + p3 + ' ' + p1 + '_' + ImType + '.json'
-                        else:
-                            cmd1 = 'rm -f ' + Im
-                            p1 = cmd1.split('.nii.gz')[0]
-                            cmd2 = p1 + '.json'
-                        print(cmd1)
-                        print(cmd2)
-                        
-                        out = os.popen(cmd1).read().strip()
-                        print(out)
-                        out = os.popen(cmd2).read().strip()
-                        print(out)
-                        i = i + 1
+# bring the index up to date with the renamed and removed images
+if not args.dry_run:
+    KUL_bids_index.updateIndex(bidsdir, args.ncpu)
@@ -14,20 +14,440 @@
 # 1- Recieve input (described in def main lines 23-47) from user 
 # 2- Find the external edge of the 2 input masks
 # 3- Find centers of gravity from numpy arrays of both input masks 
-# 4- Calculate Euclidean distances between every voxel of A to every voxel of B
+# 4- Calculate Euclidean distances between every voxel of A to the nearest voxels of B (KD-tree)
 # 5- Calculate distances between every voxel of A to cogB and vice versa
 # 6- Calculate distances between both masks' COGs
 # 7- Find index of voxels giving min distances
 # 8- Print to CLI and save to output text files and nifti files
 # 9- This is supplemented by overlap COG, respective distance calculations and overlap count and volume ratios if masks are initially overlapping
-
-## To do:
-# 1- What if more than one voxel have shortest distance?
+# 10- Alternatively (-m edt) compute signed distance maps, Hausdorff, HD95 and average symmetric surface distance using distance transforms
+# 11- Or (-m batch) measure all pairs of two lists of masks in parallel, with cached per mask preprocessing
+# 12- Or (-m labels) measure all pairs of labels in one integer label image
 
 import os, sys, getopt
+import csv, functools, glob, hashlib, json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import nibabel as nib
 import numpy as np
 from scipy import ndimage
+from scipy.spatial import cKDTree
+
+
+# nearest edge engine
+# a KD-tree of the mask B edge voxels is queried once for every mask A edge voxel
+# so memory grows with the number of edge voxels and not with their product
+# distances are compared in float32, as the old dense results matrix was,
+# so every voxel pair tied at the minimum distance is returned (sorted A then B)
+def nearest_edge_pairs(xyz1, xyz2):
+    tree2 = cKDTree(xyz2)
+    d12 = tree2.query(xyz1)[0]
+    all_min = np.float32(np.amin(d12))
+
+    # only mask A voxels whose nearest neighbour ties with the minimum can be part of a pair
+    cand = np.where(np.float32(d12) == all_min)[0]
+    # search up to the next float32, every distance that rounds to all_min lies within it
+    radius = np.float64(np.nextafter(all_min, np.float32(np.inf)))
+    pairs = []
+    for ii, neighbours in zip(cand, tree2.query_ball_point(xyz1[cand], radius)):
+        for jj in neighbours:
+            if np.float32(np.linalg.norm(xyz1[ii]-xyz2[jj])) == all_min:
+                pairs.append((ii, jj))
+    pairs.sort()
+    pairs = np.array(pairs, dtype=np.intp).reshape(-1, 2)
+
+    return all_min, (pairs[:, 0], pairs[:, 1])
+
+
+# distances between one point (e.g. a COG) and every voxel of an edge, in float32
+def point_ds(point_xyz, xyz):
+    return np.float32(np.linalg.norm(xyz - point_xyz, axis=1))
+
+
+# bounding box cropping
+# all morphology, COGs and marker maps of the pairs workflow run on the joint bounding box
+# of both masks plus a margin, which covers the 1x erosion and the 5x dilation of the markers
+# voxel coordinates are shifted back to the full grid before any distance or output,
+# and the cropped images are only pasted back into the full field of view when they are written
+crop_margin = 6
+
+
+def joint_bbox(im1_data, im2_data, margin):
+    joint = (im1_data > 0) | (im2_data > 0)
+    sl = []
+    for axis in range(joint.ndim):
+        nz = np.where(np.any(joint, axis=tuple(a for a in range(joint.ndim) if a != axis)))[0]
+        sl.append(slice(max(nz[0] - margin, 0), min(nz[-1] + margin + 1, joint.shape[axis])))
+    return tuple(sl)
+
+
+# output profiles
+# minimal: no images, only the measures and marker coordinates as json
+# compact: the cropped images, uncompressed (.nii), with the affine shifted to the crop
+# full: the full field of view images, gzipped (.nii.gz)
+# images are compressed and written on background threads, so this overlaps with the computations that follow
+# at most max_pending_writes images are queued, so only a few (full field of view) arrays are held at once
+# the write pool is only started by the first image that is saved
+output_profiles = ['minimal', 'compact', 'full']
+max_pending_writes = 4
+write_pool = None
+pending_writes = []
+
+
+def save_uncropped(data, aff, shape, sl, file_name, profile='full'):
+    global write_pool
+    if profile == 'minimal':
+        return
+    if write_pool is None:
+        write_pool = ThreadPoolExecutor(max_workers=4)
+    # wait for the oldest write before building another image
+    while len(pending_writes) >= max_pending_writes:
+        pending_writes.pop(0).result()
+    if profile == 'compact':
+        aff_c = aff.copy()
+        aff_c[:3, 3] = nib.affines.apply_affine(aff, [axis.start for axis in sl])
+        img = nib.Nifti1Image(data, aff_c)
+        file_name = file_name.replace('.nii.gz', '.nii')
+    else:
+        full = np.zeros(shape, data.dtype)
+        full[sl] = data
+        img = nib.Nifti1Image(full, aff)
+    pending_writes.append(write_pool.submit(nib.save, img, file_name))
+
+
+# wait for all background writes, re-raising any error
+def wait_for_writes():
+    for future in pending_writes:
+        future.result()
+    pending_writes.clear()
+
+
+# json safe version of numpy scalars, arrays and tuples of them
+def to_json(value):
+    return np.asarray(value).tolist()
+
+
+# marker map around one voxel (full grid coordinates), cropped: 5x dilated, the voxel itself set to 10
+def dilated_marker(shape, vv, off):
+    idx = tuple(np.int16(vv[axis]) - off[axis] for axis in range(3))
+    marker = np.zeros(shape, np.uint16)
+    marker[idx] = 1
+    dilated = np.uint16(ndimage.morphology.binary_dilation(marker, iterations=5))
+    dilated[idx] = 10
+    return dilated
+
+
+# helpers shared by the different modes
+# output dir in the current working dir, created if needed
+def output_dir(out_n):
+    pwd = str(os.popen('pwd').read()).strip()
+    os.system('mkdir -p ' + pwd + '/' + out_n + '_output')
+    return pwd + '/' + out_n + '_output'
+
+
+# get basename of input files
+# assuming the sub-* naming convention is used
+def subject_name(in1):
+    return ('_' + str(str(list(filter(lambda x: ('sub') in x, (in1.split('/'))))[0]).split('_')[0]).split('-')[1])
+
+
+# remove the numpy brackets and spaces when printing arrays to text
+def fmt(arr):
+    return str(arr).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "")
+
+
+# a mask without voxels has no edge, COG or distances, so the pairs and edt modes stop on it
+def exit_if_empty(im_data, in_file):
+    if not np.any(im_data):
+        print('No mask voxels (non-zero) found in ' + in_file + ', exiting')
+        sys.exit(1)
+
+
+# edge of a mask = mask minus its 1x erosion
+def mask_edge(im_data):
+    eroded = np.uint16(ndimage.morphology.binary_erosion(im_data))
+    return np.uint16(np.absolute(np.subtract(im_data, eroded)))
+
+
+# distance transform surface metrics
+# one Euclidean distance transform per mask, in mm using the voxel spacing from the affine,
+# gives the distance of every voxel to the edge of that mask (negative inside the mask)
+# sampling the distance map of B on the edge of A (and vice versa) gives all surface distances
+# from which Hausdorff, HD95 and the average symmetric surface distance follow
+def signed_distance_map(im_data, edge, spacing):
+    dmap = np.float32(ndimage.distance_transform_edt(edge == 0, sampling=spacing))
+    dmap[im_data > 0] *= -1
+    return dmap
+
+
+def surface_metrics(in1, in2, out_n, profile='full'):
+    img1 = nib.load(in1)
+    img2 = nib.load(in2)
+    aff1 = img1.affine
+    aff2 = img2.affine
+
+    if not np.allclose(aff1, aff2):
+        print('the affines of the inputs are not matching, please double check, exiting')
+        exit()
+
+    im1_data = np.uint16(img1.get_fdata())
+    im2_data = np.uint16(img2.get_fdata())
+    exit_if_empty(im1_data, in1)
+    exit_if_empty(im2_data, in2)
+    outline1 = mask_edge(im1_data)
+    outline2 = mask_edge(im2_data)
+
+    spacing = nib.affines.voxel_sizes(aff1)
+    sdm1 = signed_distance_map(im1_data, outline1, spacing)
+    sdm2 = signed_distance_map(im2_data, outline2, spacing)
+
+    # surface distances from the edge of A to the edge of B and vice versa
+    a2b = np.absolute(sdm2[outline1 > 0])
+    b2a = np.absolute(sdm1[outline2 > 0])
+    both = np.concatenate((a2b, b2a))
+
+    hd = np.amax(both)
+    hd95 = max(np.percentile(a2b, 95), np.percentile(b2a, 95))
+    assd = np.mean(both)
+    # signed distance of the edge of A relative to B, negative where A lies inside B (margin profile)
+    a2b_signed = sdm2[outline1 > 0]
+
+    print('Hausdorff distance between the edges of mask A and mask B = ', hd, 'mm')
+    print('95th percentile Hausdorff distance between mask A and mask B = ', hd95, 'mm')
+    print('Average symmetric surface distance between mask A and mask B = ', assd, 'mm')
+    print('Minimum signed distance of the edge of mask A to mask B = ', np.amin(a2b_signed), 'mm')
+    print('Maximum signed distance of the edge of mask A to mask B = ', np.amax(a2b_signed), 'mm')
+
+    odir = output_dir(out_n)
+    nm = subject_name(in1)
+
+    sl = tuple(slice(0, n) for n in sdm1.shape)
+    save_uncropped(sdm1, aff1, sdm1.shape, sl, odir + '/' + out_n + nm + '_mask_A_signed_distance.nii.gz', profile)
+    save_uncropped(sdm2, aff2, sdm2.shape, sl, odir + '/' + out_n + nm + '_mask_B_signed_distance.nii.gz', profile)
+
+    if profile != 'minimal':
+        with open(odir + '/' + out_n + '_output' + nm + '_surface_measures.txt', "w") as file_handler:
+            file_handler.write('Surface distances from Euclidean distance transforms of the mask edges, voxel spacing ' + fmt(spacing) + 'mm' + '\n' + \
+                '\n' + \
+                'Hausdorff distance between mask A and mask B: ' + str(hd) + 'mm \n' + \
+                '95th percentile Hausdorff distance between mask A and mask B: ' + str(hd95) + 'mm \n' + \
+                'Average symmetric surface distance between mask A and mask B: ' + str(assd) + 'mm \n' + \
+                'Mean surface distance from mask A to mask B: ' + str(np.mean(a2b)) + 'mm \n' + \
+                'Mean surface distance from mask B to mask A: ' + str(np.mean(b2a)) + 'mm \n' + \
+                '\n' + \
+                'Minimum signed distance of the edge of mask A to mask B: ' + str(np.amin(a2b_signed)) + 'mm \n' + \
+                'Maximum signed distance of the edge of mask A to mask B: ' + str(np.amax(a2b_signed)) + 'mm \n')
+
+    with open(odir + '/' + out_n + '_output' + nm + '_surface_measures.json', 'w') as f:
+        json.dump({'voxel_spacing_mm': to_json(spacing), 'hausdorff_mm': to_json(hd), 'hd95_mm': to_json(hd95), \
+            'assd_mm': to_json(assd), 'mean_A_2_B_mm': to_json(np.mean(a2b)), 'mean_B_2_A_mm': to_json(np.mean(b2a)), \
+            'min_signed_A_2_B_mm': to_json(np.amin(a2b_signed)), 'max_signed_A_2_B_mm': to_json(np.amax(a2b_signed))}, f, indent=2)
+    wait_for_writes()
+
+
+# batch mode
+# every mask is preprocessed once (edge voxels, COG, affine) and cached as an npz in the output dir
+# the cache key is the absolute path, size and mtime of the mask, so only changed or new masks are redone
+# all A x B pairs are then measured across a process pool and written to one long-format csv
+# rows of pairs whose masks did not change are taken over from the previous table
+batch_columns = ['mask_A', 'mask_B', 'min_dist_mm', 'n_min_pairs', \
+    'A_vox_i', 'A_vox_j', 'A_vox_k', 'A_x', 'A_y', 'A_z', \
+    'B_vox_i', 'B_vox_j', 'B_vox_k', 'B_x', 'B_y', 'B_z', \
+    'COGs_dist_mm', 'COGA_2_B_min_mm', 'COGB_2_A_min_mm', \
+    'overlap_vox', 'overlap_perc_A', 'overlap_perc_B', 'key_A', 'key_B']
+
+
+def expand_masks(arg):
+    # a comma separated list of files and/or glob patterns
+    masks = []
+    for item in arg.split(','):
+        found = sorted(glob.glob(item))
+        if not found:
+            print('No masks found for ' + item)
+        masks.extend(found)
+    return masks
+
+
+def mask_key(mask):
+    st = os.stat(mask)
+    return hashlib.sha1((os.path.abspath(mask) + '|' + str(st.st_size) + '|' + str(st.st_mtime_ns)).encode()).hexdigest()[:16]
+
+
+def prep_mask(mask, cache_dir):
+    key = mask_key(mask)
+    cache_file = os.path.join(cache_dir, key + '.npz')
+    if not os.path.exists(cache_file):
+        img = nib.load(mask)
+        im_data = np.uint16(img.get_fdata())
+        ijk = np.vstack(np.where(mask_edge(im_data))).T
+        cog = np.array(ndimage.measurements.center_of_mass(im_data))
+        # write to a temp file first, so an interrupted run never leaves a broken cache entry
+        tmp_file = os.path.join(cache_dir, key + '.tmp.npz')
+        np.savez(tmp_file, affine=img.affine, shape=np.array(im_data.shape), ijk=ijk, \
+            xyz=nib.affines.apply_affine(img.affine, ijk), cog=cog, \
+            cog_xyz=nib.affines.apply_affine(img.affine, cog), vox=np.flatnonzero(im_data))
+        os.replace(tmp_file, cache_file)
+    return key, cache_file
+
+
+@functools.lru_cache(maxsize=64)
+def load_prep(cache_file):
+    with np.load(cache_file) as npz:
+        return {k: npz[k] for k in npz.files}
+
+
+def pair_measures(job):
+    mask_a, key_a, cache_a, mask_b, key_b, cache_b = job
+    pa = load_prep(cache_a)
+    pb = load_prep(cache_b)
+
+    all_min, alidx = nearest_edge_pairs(pa['xyz'], pb['xyz'])
+    ia = alidx[0][0]
+    ib = alidx[1][0]
+    ov_count = np.intersect1d(pa['vox'], pb['vox'], assume_unique=True).shape[0]
+
+    return [mask_a, mask_b, all_min, alidx[0].shape[0]] + \
+        list(pa['ijk'][ia]) + list(pa['xyz'][ia]) + \
+        list(pb['ijk'][ib]) + list(pb['xyz'][ib]) + \
+        [np.linalg.norm(pa['cog_xyz']-pb['cog_xyz']), \
+        np.amin(point_ds(pa['cog_xyz'], pb['xyz'])), \
+        np.amin(point_ds(pb['cog_xyz'], pa['xyz'])), \
+        ov_count, 100.0 * ov_count / pa['vox'].shape[0], 100.0 * ov_count / pb['vox'].shape[0], \
+        key_a, key_b]
+
+
+def batch_distances(in1, in2, out_n, ncpu):
+    masks_a = expand_masks(in1)
+    masks_b = expand_masks(in2)
+    odir = output_dir(out_n)
+    cache_dir = os.path.join(odir, 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    table = os.path.join(odir, out_n + '_batch_distances.csv')
+
+    # preprocess every mask once
+    all_masks = list(dict.fromkeys(masks_a + masks_b))
+    with ProcessPoolExecutor(max_workers=ncpu) as pool:
+        preps = dict(zip(all_masks, pool.map(prep_mask, all_masks, [cache_dir] * len(all_masks))))
+
+    # sanity check, are the affines the same or close enough ? (compared to the first mask)
+    ref = load_prep(preps[all_masks[0]][1])
+    skip = []
+    for mask in all_masks:
+        prep = load_prep(preps[mask][1])
+        if not (np.array_equal(prep['shape'], ref['shape']) and np.allclose(prep['affine'], ref['affine'])):
+            print('the affine of ' + mask + ' is not matching ' + all_masks[0] + ', skipping it')
+            skip.append(mask)
+        elif prep['ijk'].shape[0] == 0:
+            print(mask + ' is empty, skipping it')
+            skip.append(mask)
+
+    # reuse rows of the previous table if both masks are unchanged
+    done = {}
+    if os.path.exists(table):
+        with open(table, 'r') as f:
+            for row in csv.reader(f):
+                if row and row[0] != 'mask_A':
+                    done[(row[-2], row[-1])] = row
+
+    rows = []
+    jobs = []
+    for mask_a in masks_a:
+        for mask_b in masks_b:
+            if mask_a in skip or mask_b in skip:
+                continue
+            key_a, cache_a = preps[mask_a]
+            key_b, cache_b = preps[mask_b]
+            if (key_a, key_b) in done:
+                rows.append(done[(key_a, key_b)])
+            else:
+                rows.append(None)
+                jobs.append((mask_a, key_a, cache_a, mask_b, key_b, cache_b))
+
+    print('Measuring ' + str(len(jobs)) + ' of ' + str(len(rows)) + ' pairs, the others are unchanged')
+    with ProcessPoolExecutor(max_workers=ncpu) as pool:
+        new_rows = iter(pool.map(pair_measures, jobs, chunksize=max(1, len(jobs) // (4 * ncpu))))
+        rows = [row if row is not None else next(new_rows) for row in rows]
+
+    with open(table, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(batch_columns)
+        writer.writerows(rows)
+    print('Written ' + table)
+
+
+# multi-label mode
+# takes one integer label image (e.g. a parcellation or split spheres) instead of two binary masks
+# the edges of all labels are found in one pass: a voxel is inside its label if all its neighbours
+# (the binary_erosion structure) carry the same label, otherwise it is an edge voxel
+# this gives K x K matrices of minimum edge distance, COG distance and overlap voxels
+# and a long table with the closest voxel pairs of every label pair
+def label_edges(lab_data):
+    struct = ndimage.generate_binary_structure(3, 1)
+    lab_min = ndimage.minimum_filter(lab_data, footprint=struct, mode='constant', cval=0)
+    lab_max = ndimage.maximum_filter(lab_data, footprint=struct, mode='constant', cval=0)
+    return np.where((lab_min != lab_max) | (lab_min == 0), lab_data, 0)
+
+
+def write_matrix(file_name, labels, matrix):
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['label'] + list(labels))
+        for label, row in zip(labels, matrix):
+            writer.writerow([label] + list(row))
+
+
+def label_distances(in1, out_n):
+    img = nib.load(in1)
+    aff = img.affine
+    lab_data = np.int32(np.round(img.get_fdata()))
+    labels = np.unique(lab_data)
+    labels = labels[labels > 0]
+    K = labels.shape[0]
+    if K == 0:
+        print('No labels (non-zero voxels) found in ' + in1 + ', exiting')
+        sys.exit(1)
+    print('Found ' + str(K) + ' labels')
+
+    # edge voxels of all labels, grouped per label
+    edges = label_edges(lab_data)
+    ijk_all = np.vstack(np.where(edges)).T
+    lab_all = edges[tuple(ijk_all.T)]
+    order = np.argsort(lab_all, kind='stable')
+    ijk_all = ijk_all[order]
+    bounds = np.searchsorted(lab_all[order], np.append(labels, labels[-1] + 1))
+    ijk = [ijk_all[bounds[ii]:bounds[ii+1]] for ii in range(K)]
+    xyz = [nib.affines.apply_affine(aff, v) for v in ijk]
+
+    # COGs and volumes of all labels at once
+    cogs = np.array(ndimage.measurements.center_of_mass(np.ones(lab_data.shape, np.uint8), lab_data, labels))
+    cogs_xyz = nib.affines.apply_affine(aff, cogs)
+    cog_ds = np.linalg.norm(cogs_xyz[:, None, :] - cogs_xyz[None, :, :], axis=2)
+    # labels in one image cannot overlap, the diagonal holds the volume of each label in voxels
+    overlap = np.diag(ndimage.sum_labels(np.ones(lab_data.shape, np.uint32), lab_data, labels).astype(np.int64))
+
+    min_ds = np.zeros((K, K), np.float32)
+    rows = []
+    for ii in range(K):
+        for jj in range(ii + 1, K):
+            all_min, alidx = nearest_edge_pairs(xyz[ii], xyz[jj])
+            min_ds[ii, jj] = min_ds[jj, ii] = all_min
+            ia = alidx[0][0]
+            ib = alidx[1][0]
+            rows.append([labels[ii], labels[jj], all_min, alidx[0].shape[0]] + \
+                list(ijk[ii][ia]) + list(xyz[ii][ia]) + list(ijk[jj][ib]) + list(xyz[jj][ib]) + \
+                [cog_ds[ii, jj]])
+
+    odir = output_dir(out_n)
+    write_matrix(os.path.join(odir, out_n + '_labels_min_edge_dist.csv'), labels, min_ds)
+    write_matrix(os.path.join(odir, out_n + '_labels_COG_dist.csv'), labels, cog_ds)
+    write_matrix(os.path.join(odir, out_n + '_labels_overlap_vox.csv'), labels, overlap)
+    with open(os.path.join(odir, out_n + '_labels_closest_voxels.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['label_A', 'label_B', 'min_dist_mm', 'n_min_pairs', \
+            'A_vox_i', 'A_vox_j', 'A_vox_k', 'A_x', 'A_y', 'A_z', \
+            'B_vox_i', 'B_vox_j', 'B_vox_k', 'B_x', 'B_y', 'B_z', 'COGs_dist_mm'])
+        writer.writerows(rows)
+    print('Written label matrices to ' + odir)
+
 
 # define main input function here
 def main(argv):
@@ -35,10 +455,13 @@ def main(argv):
     inii = ''
     iname = ''
     ofolder = ''
+    mode = 'pairs'
+    ncpu = os.cpu_count()
+    profile = 'full'
     try:
-        opts, args = getopt.getopt(argv,"ha:b:o:",["in1=","in2=","o="])
+        opts, args = getopt.getopt(argv,"ha:b:o:m:n:p:",["in1=","in2=","o=","mode=","ncpu=","profile="])
     except getopt.GetoptError:
-        print ('KUL_EDs_b2masks.py -a <in1> -b <in2> -o <out>')
+        print ('KUL_EDs_b2masks.py -a <in1> -b <in2> -o <out> [-m <pairs|edt|batch|labels>] [-n <ncpu>] [-p <minimal|compact|full>]')
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
@@ -46,7 +469,16 @@ def main(argv):
             print ('KUL_EDs_b2masks.py will also check for initial overlap and calculate distances to and from overlapping voxels as well')
             print ('The two input masks must be in the same space and have the same dimensions')
             print ('The first mask should be the smaller one (e.g. DES sphere, or lesion mask), and the second the larger (e.g. CST)')
-            print ('KUL_EDs_between_2masks.py -a <in1> -b <in2> -o <out>')
+            print ('Mode -m pairs (default) gives voxel-wise minimum distances, COG distances and overlap measures')
+            print ('Mode -m edt gives signed distance maps, Hausdorff, HD95 and average symmetric surface distance using distance transforms')
+            print ('Mode -m batch takes comma separated lists and/or quoted globs of masks for -a and -b')
+            print ('  and writes the measures of all pairs to one csv table, using -n <ncpu> processes')
+            print ('  per mask preprocessing is cached in the output dir, so rerunning only measures new or changed masks')
+            print ('Mode -m labels takes one integer label image for -a (no -b) and writes K x K matrices of')
+            print ('  minimum edge distance, COG distance and overlap voxels, and the closest voxel pairs of all labels')
+            print ('Output profile -p (pairs and edt modes): minimal writes only a json of the measures and marker coordinates,')
+            print ('  compact also writes the images cropped to the masks and uncompressed, full (default) writes all images as full size nii.gz')
+            print ('KUL_EDs_between_2masks.py -a <in1> -b <in2> -o <out> [-m <pairs|edt|batch|labels>] [-n <ncpu>] [-p <minimal|compact|full>]')
             sys.exit()
         elif opt in ("-a", "--in1"):
             in1 = arg
@@ -54,10 +486,33 @@ def main(argv):
             in2 = arg
         elif opt in ("-o", "--out"):
             out = arg
+        elif opt in ("-m", "--mode"):
+            mode = arg
+        elif opt in ("-n", "--ncpu"):
+            ncpu = int(arg)
+        elif opt in ("-p", "--profile"):
+            profile = arg
+    if profile not in output_profiles:
+        print ('Unknown output profile ' + profile + ', use one of ' + ', '.join(output_profiles))
+        sys.exit(2)
+
+    if mode == 'labels':
+        print ('Input full path and file name for the label image "', in1)
+        print ('Prefix output name "', out)
+        label_distances(in1, out)
+        return
+
     print ('Input full path and file name for the first mask image "', in1)
     print ('Input full path and file name for the second mask image "', in2)
     print ('Prefix output name "', out)
 
+    if mode == 'edt':
+        surface_metrics(in1, in2, out, profile)
+        return
+    elif mode == 'batch':
+        batch_distances(in1, in2, out, ncpu)
+        return
+
     # for debugging
     # in1 = '/media/radwan/AR_16T/S61759_BIDS_fMRI/BIDS/derivatives/Warping_2_native/ECS/sub-PT004_ECS2nat/sub-PT004_ECS_split/Spheres_split_2_reconned.nii.gz'
     # in2 = '/media/radwan/AR_16T/S61759_BIDS_fMRI/BIDS/derivatives/Warping_2_native/ECS/sub-PT004_ECS2nat/sub-PT004_ECS_split/Spheres_split_3_reconned.nii.gz'
@@ -74,10 +529,18 @@ def main(argv):
 
     # sanity check, are the affines the same or close enough ?
     if np.allclose(aff1, aff2):
-        # for each input convert fdata to 16bit uint
+        # for each input convert data to 16bit uint
         # then do a 1x iterative cleaning, 1x erosion, absolute difference is the edge
-        im1_data = np.uint16(img1.get_fdata())
-        im2_data = np.uint16(img2.get_fdata())
+        # everything below runs on the joint bounding box (sl) of both masks, off is its corner
+        full_shape = img1.shape
+        im1_data = np.uint16(np.asanyarray(img1.dataobj))
+        im2_data = np.uint16(np.asanyarray(img2.dataobj))
+        exit_if_empty(im1_data, in1)
+        exit_if_empty(im2_data, in2)
+        sl = joint_bbox(im1_data, im2_data, crop_margin)
+        off = np.array([axis.start for axis in sl])
+        im1_data = im1_data[sl].copy()
+        im2_data = im2_data[sl].copy()
 
         # here we start checking for initial overlaps
         # if this is found we can follow a different workflow
@@ -114,60 +577,35 @@ def main(argv):
         img1_idx = np.where(outline1)
         img2_idx = np.where(outline2)
 
-        # to get cogs in voxel coords
-        cog1 = ndimage.measurements.center_of_mass(im1_data)
-        cog2 = ndimage.measurements.center_of_mass(im2_data)
+        # to get cogs in voxel coords (of the full grid)
+        cog1 = tuple(np.add(ndimage.measurements.center_of_mass(im1_data), off))
+        cog2 = tuple(np.add(ndimage.measurements.center_of_mass(im2_data), off))
         # then convert voxel coords to mm
         cog1_xyz = nib.affines.apply_affine(aff1, cog1)
         cog2_xyz = nib.affines.apply_affine(aff2, cog2)
 
-        # list of arrays to (voxels, 3) array
-        ijk1 = np.vstack(img1_idx).T
-        ijk2 = np.vstack(img2_idx).T
+        # list of arrays to (voxels, 3) array, in voxel coords of the full grid
+        ijk1 = np.vstack(img1_idx).T + off
+        ijk2 = np.vstack(img2_idx).T + off
 
         # convert the voxel coordinates to mm coordinates
         xyz1 = nib.affines.apply_affine(aff1, ijk1)
         xyz2 = nib.affines.apply_affine(aff2, ijk2)
 
-        # declare empty numpy arrays
-        # to enable recovery of voxel coordinates afterwards
-        results = np.zeros((ijk1.shape[0], ijk2.shape[0]), np.float32)
-        cog1_ds = np.zeros((ijk2.shape[0]), np.float32)
-        cog2_ds = np.zeros((ijk1.shape[0]), np.float32)
-
-        vox_A_maps = np.zeros(im1_data.shape, np.uint16)
-        vox_B_maps = np.zeros(im2_data.shape, np.uint16)
-        COGA_map = np.zeros(im1_data.shape, np.uint16)
-        COGB_map = np.zeros(im2_data.shape, np.uint16)
-
         # what is the distance between the COGs of both masks
         cogs_d = np.linalg.norm(cog1_xyz-cog2_xyz)
 
-        # loop 1 over in1 nonzero voxel mm coordinates
         # calculate cog2 distance to every voxel in in1
-        # loop 2 over in2 nonzero voxel mm coordinates
-        # calculate distances between every voxel in in1 to in2
-        for ii in range(0,xyz1.shape[0]):
-            cog2_ds[ii] = np.linalg.norm(cog2_xyz-xyz1[ii])
-            for jj in range(0,xyz2.shape[0]):
-                results[ii,jj] = np.linalg.norm(xyz1[ii]-xyz2[jj])
-                
-
-        # loop 3 over nonzero voxels in in2
-        # calculate distances between cog1 and every voxel in in2
-        for uu in range(0,xyz2.shape[0]):
-            cog1_ds[uu] = np.linalg.norm(cog1_xyz-xyz2[uu])
-
+        # calculate cog1 distance to every voxel in in2
+        cog2_ds = point_ds(cog2_xyz, xyz1)
+        cog1_ds = point_ds(cog1_xyz, xyz2)
 
-        # convert all to numpy arrays for safety
         # find min ds
-        all_min = (np.amin(results))
+        # the shortest distance between in1 and in2 and all voxel pairs giving it
+        all_min, alidx = nearest_edge_pairs(xyz1, xyz2)
         coga_2b = (np.amin(cog1_ds))
         cogb_2a = (np.amin(cog2_ds))
 
-        # find index of min distance entry
-        alidx = np.where(results == all_min)
-        
         # grab the coordinates of the voxels giving shortest ds from both masks
         a_vox_mm = xyz1[alidx[0]]
         a_vox_vv = ijk1[alidx[0]]
@@ -209,35 +647,18 @@ def main(argv):
             # to get the count, indices and coordinates of overlapping voxels
             ov_count = np.count_nonzero(in_overlap)
             ov_idx = np.where(in_overlap)
-            ov_ijk = np.vstack(ov_idx).T
+            ov_ijk = np.vstack(ov_idx).T + off
             ov_xyz = nib.affines.apply_affine(aff2, ov_ijk) # this actually works
 
-            ov_cog_ijk = ndimage.measurements.center_of_mass(in_overlap)
+            ov_cog_ijk = tuple(np.add(ndimage.measurements.center_of_mass(in_overlap), off))
             ov_cog_xyz = nib.affines.apply_affine(aff2, ov_cog_ijk)
 
-            # create empty arrays for distances
-            ov_cog_2_maskAv_ds = np.zeros((ijk1.shape[0]), np.float32) # for ov COG to mask A voxels
-            OVv_2_maskACOG_ds = np.zeros((ov_ijk.shape[0]), np.float32) # for ov voxels to COGA
-            OVv_2_maskBCOG_ds = np.zeros((ov_ijk.shape[0]), np.float32) # for ov voxels to COGB
-
-            # create empty arrays for voxel maps
-            ov_cog_2_maskAv_map = np.zeros(im1_data.shape, np.uint16)
-            OVv_2_maskACOG_map = np.zeros(in_overlap.shape, np.uint16)
-            OVv_2_maskBCOG_map = np.zeros(in_overlap.shape, np.uint16)
+            # dist. between all maskA voxels and ov_COG
+            ov_cog_2_maskAv_ds = point_ds(ov_cog_xyz, xyz1)
 
-            ov_Vox_map = np.zeros(in_overlap.shape, np.uint16) # for mapping the overlapping voxels to image
-            ov_Vox_COG_map = np.zeros(in_overlap.shape, np.uint16) # for mapping COG of overlapping voxels
-
-
-            # loop 1 to get dist. between all maskA voxels and ov_COG
-            for ww in range(0,xyz1.shape[0]):
-                ov_cog_2_maskAv_ds[ww] = np.linalg.norm(xyz1[ww]-ov_cog_xyz)
-
-
-            # loop 2 to get dist. between all ov voxels and maskA_COG
-            for ff in range(0,ov_xyz.shape[0]):
-                OVv_2_maskACOG_ds[ff] = np.linalg.norm(ov_xyz[ff]-cog1_xyz)
-                OVv_2_maskBCOG_ds[ff] = np.linalg.norm(ov_xyz[ff]-cog2_xyz)
+            # dist. between all ov voxels and maskA_COG and maskB_COG
+            OVv_2_maskACOG_ds = point_ds(cog1_xyz, ov_xyz)
+            OVv_2_maskBCOG_ds = point_ds(cog2_xyz, ov_xyz)
 
             # find mins
             min_AvsOVCOG_d = np.amin(ov_cog_2_maskAv_ds)
@@ -257,33 +678,26 @@ def main(argv):
             cc_vox_mm = ov_xyz[idx_3[0]]
             cc_vox_vv = ov_ijk[idx_3[0]]
 
-            # create array for ov_COG 2 maskA_voxels
-            ov_cog_2_maskAv_map[np.int16(ca_vox_vv[0][0]), np.int16(ca_vox_vv[0][1]), np.int16(ca_vox_vv[0][2])] = 1
-            dil_11 = np.uint16(ndimage.morphology.binary_dilation(ov_cog_2_maskAv_map, iterations=5))
-            dil_11[np.int16(ca_vox_vv[0][0]), np.int16(ca_vox_vv[0][1]), np.int16(ca_vox_vv[0][2])] = 10
-            # create array for ov voxels to maskA COG
-            OVv_2_maskACOG_map[np.int16(cb_vox_vv[0][0]), np.int16(cb_vox_vv[0][1]), np.int16(cb_vox_vv[0][2])] = 1
-            dil_22 = np.uint16(ndimage.morphology.binary_dilation(OVv_2_maskACOG_map, iterations=5))
-            dil_22[np.int16(cb_vox_vv[0][0]), np.int16(cb_vox_vv[0][1]), np.int16(cb_vox_vv[0][2])] = 10
-            # create array for ov voxels to maskB COG
-            OVv_2_maskBCOG_map[np.int16(cc_vox_vv[0][0]), np.int16(cc_vox_vv[0][1]), np.int16(cc_vox_vv[0][2])] = 1
-            dil_33 = np.uint16(ndimage.morphology.binary_dilation(OVv_2_maskBCOG_map, iterations=5))
-            dil_33[np.int16(cc_vox_vv[0][0]), np.int16(cc_vox_vv[0][1]), np.int16(cc_vox_vv[0][2])] = 10
-
-            # Create array for ov_COG image and dilate
-            ov_Vox_COG_map[np.int16(ov_cog_ijk[0]), np.int16(ov_cog_ijk[1]), np.int16(ov_cog_ijk[2])] = 1
-            dilated_cogOV = np.uint16(ndimage.morphology.binary_dilation(ov_Vox_COG_map, iterations=5))
-            dilated_cogOV[np.int16(ov_cog_ijk[0]), np.int16(ov_cog_ijk[1]), np.int16(ov_cog_ijk[2])] = 10
-
-            # Create array for all ov_voxels image (will need a for loop)
-            for qq in range(0,ov_xyz.shape[0]):
-                ov_Vox_map[np.int16(ov_ijk[qq][0]), np.int16(ov_ijk[qq][1]), np.int16(ov_ijk[qq][2])] = 1
-
-            nib.save(nib.Nifti1Image(np.uint16(ov_Vox_map), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_initial_overlapping_voxels.nii.gz')
-            nib.save(nib.Nifti1Image(np.uint16(dilated_cogOV), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_initial_overlapping_voxels_COG.nii.gz')
-            nib.save(nib.Nifti1Image(np.uint16(dil_11), aff1), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_maskA_vox_mindist_2_overlap_COG.nii.gz')
-            nib.save(nib.Nifti1Image(np.uint16(dil_22), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_overlap_vox_mindist_2_mask_A_COG.nii.gz')
-            nib.save(nib.Nifti1Image(np.uint16(dil_33), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_overlap_vox_mindist_2_mask_B_COG.nii.gz')
+            # the marker images are only made when they are written (not in the minimal profile)
+            if profile != 'minimal':
+                # create array for ov_COG 2 maskA_voxels
+                dil_11 = dilated_marker(in_overlap.shape, ca_vox_vv[0], off)
+                # create array for ov voxels to maskA COG
+                dil_22 = dilated_marker(in_overlap.shape, cb_vox_vv[0], off)
+                # create array for ov voxels to maskB COG
+                dil_33 = dilated_marker(in_overlap.shape, cc_vox_vv[0], off)
+
+                # Create array for ov_COG image and dilate
+                dilated_cogOV = dilated_marker(in_overlap.shape, ov_cog_ijk, off)
+
+                # Create array for all ov_voxels image
+                ov_Vox_map = np.uint16(in_overlap != 0)
+
+                save_uncropped(ov_Vox_map, aff2, full_shape, sl, pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_initial_overlapping_voxels.nii.gz', profile)
+                save_uncropped(dilated_cogOV, aff2, full_shape, sl, pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_initial_overlapping_voxels_COG.nii.gz', profile)
+                save_uncropped(dil_11, aff1, full_shape, sl, pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_maskA_vox_mindist_2_overlap_COG.nii.gz', profile)
+                save_uncropped(dil_22, aff2, full_shape, sl, pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_overlap_vox_mindist_2_mask_A_COG.nii.gz', profile)
+                save_uncropped(dil_33, aff2, full_shape, sl, pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_overlap_vox_mindist_2_mask_B_COG.nii.gz', profile)
 
             # calc percent overlap
             ov_perc_mB = 100.0 * np.float32(np.count_nonzero(ov_ijk)) / np.float32(np.count_nonzero(im2_data))
@@ -299,87 +713,101 @@ def main(argv):
 
             # need to propagate to results text file then append later results to it without overwriting
             # also need to save overlap to nifti image ;)
-            with open(pwd + '/' + out_n + '_output/' +  out_n + '_output' + nm + '_output_measures.txt', "w" ) as file_handler:
-                file_handler.write('Initial overlap found between both masks, distance calculations using overlapping voxels, their COG, as well as external outlines and COGs of both masks' + '\n' + \
-                '\n' + \
-                'Minimum distance between COG of overlapping voxels and all voxels of mask A = ' + str(min_AvsOVCOG_d).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
-                'Minimum distance between COG of mask A and all overlapping voxels = ' + str(min_OV2ACOG_d).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
-                'Minimum distance between COG of mask B and all overlapping voxels = ' + str(min_OV2BCOG_d).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
-                '\n' + \
-                'Number of overlapping voxels between both masks: ' + str(ov_count) + ' voxels' + '\n' + \
-                'Percent volume overlap between masks relative to mask A = ' + str(ov_perc_mA) + '%' + '\n' + \
-                'Percent volume overlap between masks relative to mask B = ' + str(ov_perc_mB) + '%' + '\n' \
-                '\n')
-                file_handler.close()
+            if profile != 'minimal':
+                with open(pwd + '/' + out_n + '_output/' +  out_n + '_output' + nm + '_output_measures.txt', "w" ) as file_handler:
+                    file_handler.write('Initial overlap found between both masks, distance calculations using overlapping voxels, their COG, as well as external outlines and COGs of both masks' + '\n' + \
+                    '\n' + \
+                    'Minimum distance between COG of overlapping voxels and all voxels of mask A = ' + str(min_AvsOVCOG_d).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
+                    'Minimum distance between COG of mask A and all overlapping voxels = ' + str(min_OV2ACOG_d).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
+                    'Minimum distance between COG of mask B and all overlapping voxels = ' + str(min_OV2BCOG_d).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
+                    '\n' + \
+                    'Number of overlapping voxels between both masks: ' + str(ov_count) + ' voxels' + '\n' + \
+                    'Percent volume overlap between masks relative to mask A = ' + str(ov_perc_mA) + '%' + '\n' + \
+                    'Percent volume overlap between masks relative to mask B = ' + str(ov_perc_mB) + '%' + '\n' \
+                    '\n')
+                    file_handler.close()
 
         elif wf == 2:
             # print('No overlap found')
             # need to propagate to results text file then append later results to it without overwriting
-            with open(pwd + '/' + out_n + '_output/' +  out_n + '_output' + nm + '_output_measures.txt', "w" ) as file_handler:
-                file_handler.write('No overlap found between both masks, distance calculations done using external outlines and COGs only' + '\n' + '\n')
-                file_handler.close()
+            if profile != 'minimal':
+                with open(pwd + '/' + out_n + '_output/' +  out_n + '_output' + nm + '_output_measures.txt', "w" ) as file_handler:
+                    file_handler.write('No overlap found between both masks, distance calculations done using external outlines and COGs only' + '\n' + '\n')
+                    file_handler.close()
 
         # Save intermediate images to nii.gz in output dir
-        nib.save(nib.Nifti1Image(outline1, aff1), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_edge.nii.gz')
-        nib.save(nib.Nifti1Image(outline2, aff2), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_edge.nii.gz')
+        save_uncropped(outline1, aff1, full_shape, sl, pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_edge.nii.gz', profile)
+        save_uncropped(outline2, aff2, full_shape, sl, pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_edge.nii.gz', profile)
 
         # needs a better cleanup strategy than simple morpho closure
         # potential helpful option -> https://www.delftstack.com/howto/python/smooth-data-in-python/
         # nib.save(nib.Nifti1Image(clean_im1, aff1), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_cleaned.nii.gz')
         # nib.save(nib.Nifti1Image(clean_im2, aff2), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_cleaned.nii.gz')
         
-        nib.save(nib.Nifti1Image(im1_data, aff1), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A.nii.gz')
-        nib.save(nib.Nifti1Image(im2_data, aff2), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B.nii.gz')
+        save_uncropped(im1_data, aff1, full_shape, sl, pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A.nii.gz', profile)
+        save_uncropped(im2_data, aff2, full_shape, sl, pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B.nii.gz', profile)
 
-        nib.save(nib.Nifti1Image(eroded_im1, aff1), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_eroded.nii.gz')
-        nib.save(nib.Nifti1Image(eroded_im2, aff2), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_eroded.nii.gz')
+        save_uncropped(eroded_im1, aff1, full_shape, sl, pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_eroded.nii.gz', profile)
+        save_uncropped(eroded_im2, aff2, full_shape, sl, pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_eroded.nii.gz', profile)
 
         # save output measures to a text file
-        with open(pwd + '/' + out_n + '_output/' +  out_n + '_output' + nm + '_output_measures.txt', "a+" ) as file_handler:
-            file_handler.write('Minimum distance between all voxels of mask A and mask B: ' + \
-                str(all_min) + 'mm \n' + \
-                'This is found between:- ' + '\n' + \
-                'Mask A voxel at voxel coordinates: ' + str(a_vox_vv).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'Mask A voxel at mm coordinates: ' + str(a_vox_mm).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' \
-                'Mask B voxel at voxel coordinates: ' + str(b_vox_vv).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'Mask B voxel at mm coordinates: ' + str(b_vox_mm).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                '\n' + \
-                'Minimum distance between COG of mask A and COG of mask B: ' + str(cogs_d) + 'mm \n' + \
-                'COG of mask A voxel coordinates: ' + str(cog1).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'COG of mask A mm coordinates: ' + str(cog1_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'COG of mask B voxel coordinates :' + str(cog2).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'COG of mask B mm coordinates: ' + str(cog2_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                '\n' + \
-                'Minimum distance between COG of mask A and all voxels of mask B: ' + str(coga_2b) + 'mm \n' + \
-                'Mask B voxel(s) with shortest distance to mask A COG voxel coordinates: ' + str(ca2bijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'Mask B voxel(s) with shortest distance to mask A COG mm coordinates: ' + str(ca2bxyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                '\n' + \
-                'Minimum distance between COG of mask B and all voxels of mask A: ' + str(cogb_2a) + 'mm \n' + \
-                'Mask A voxel(s) with shortest distance to mask B COG voxel coordinates: ' + str(cb2aijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'Mask A voxel(s) with shortest distance to mask B COG mm coordinates: ' + str(cb2axyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n')
+        if profile != 'minimal':
+            with open(pwd + '/' + out_n + '_output/' +  out_n + '_output' + nm + '_output_measures.txt', "a+" ) as file_handler:
+                file_handler.write('Minimum distance between all voxels of mask A and mask B: ' + \
+                    str(all_min) + 'mm \n' + \
+                    'This is found between:- ' + '\n' + \
+                    'Mask A voxel at voxel coordinates: ' + str(a_vox_vv).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+                    'Mask A voxel at mm coordinates: ' + str(a_vox_mm).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' \
+                    'Mask B voxel at voxel coordinates: ' + str(b_vox_vv).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+                    'Mask B voxel at mm coordinates: ' + str(b_vox_mm).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+                    '\n' + \
+                    'Minimum distance between COG of mask A and COG of mask B: ' + str(cogs_d) + 'mm \n' + \
+                    'COG of mask A voxel coordinates: ' + str(cog1).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+                    'COG of mask A mm coordinates: ' + str(cog1_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+                    'COG of mask B voxel coordinates :' + str(cog2).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+                    'COG of mask B mm coordinates: ' + str(cog2_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+                    '\n' + \
+                    'Minimum distance between COG of mask A and all voxels of mask B: ' + str(coga_2b) + 'mm \n' + \
+                    'Mask B voxel(s) with shortest distance to mask A COG voxel coordinates: ' + str(ca2bijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+                    'Mask B voxel(s) with shortest distance to mask A COG mm coordinates: ' + str(ca2bxyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+                    '\n' + \
+                    'Minimum distance between COG of mask B and all voxels of mask A: ' + str(cogb_2a) + 'mm \n' + \
+                    'Mask A voxel(s) with shortest distance to mask B COG voxel coordinates: ' + str(cb2aijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+                    'Mask A voxel(s) with shortest distance to mask B COG mm coordinates: ' + str(cb2axyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n')
                 
                 
         # save voxels of min distances to two different images
         # save voxels of min distances to the same image or different images ??
-        vox_A_maps[np.int16(a_vox_vv[0][0]), np.int16(a_vox_vv[0][1]), np.int16(a_vox_vv[0][2])] = 1
-        COGA_map[np.int16(cog1[0]), np.int16(cog1[1]), np.int16(cog1[2])] = 1
-        vox_B_maps[np.int16(b_vox_vv[0][0]), np.int16(b_vox_vv[0][1]), np.int16(b_vox_vv[0][2])] = 1
-        COGB_map[np.int16(cog2[0]), np.int16(cog2[1]), np.int16(cog2[2])] = 1
-        dilated_A = np.uint16(ndimage.morphology.binary_dilation(vox_A_maps, iterations=5))
-        dilated_cogA = np.uint16(ndimage.morphology.binary_dilation(COGA_map, iterations=5))
-        dilated_B = np.uint16(ndimage.morphology.binary_dilation(vox_B_maps, iterations=5))
-        dilated_cogB = np.uint16(ndimage.morphology.binary_dilation(COGB_map, iterations=5))
-
-        dilated_A[np.int16(a_vox_vv[0][0]), np.int16(a_vox_vv[0][1]), np.int16(a_vox_vv[0][2])] = 10
-        dilated_B[np.int16(b_vox_vv[0][0]), np.int16(b_vox_vv[0][1]), np.int16(b_vox_vv[0][2])] = 10
-        dilated_cogA[np.int16(cog1[0]), np.int16(cog1[1]), np.int16(cog1[2])] = 10
-        dilated_cogB[np.int16(cog2[0]), np.int16(cog2[1]), np.int16(cog2[2])] = 10
-        
-        # save these voxel maps
-        nib.save(nib.Nifti1Image(np.uint16(dilated_A), aff1), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_vox_mindist_2_all_B_mask_vox.nii.gz')
-        nib.save(nib.Nifti1Image(np.uint16(dilated_B), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_vox_mindist_2_all_A_mask_vox.nii.gz')
-        nib.save(nib.Nifti1Image(np.uint16(dilated_cogA), aff1), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_COG.nii.gz')
-        nib.save(nib.Nifti1Image(np.uint16(dilated_cogB), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_COG.nii.gz')
+        # (not in the minimal profile, which writes no images)
+        if profile != 'minimal':
+            dilated_A = dilated_marker(im1_data.shape, a_vox_vv[0], off)
+            dilated_B = dilated_marker(im2_data.shape, b_vox_vv[0], off)
+            dilated_cogA = dilated_marker(im1_data.shape, cog1, off)
+            dilated_cogB = dilated_marker(im2_data.shape, cog2, off)
+
+            # save these voxel maps
+            save_uncropped(dilated_A, aff1, full_shape, sl, pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_vox_mindist_2_all_B_mask_vox.nii.gz', profile)
+            save_uncropped(dilated_B, aff2, full_shape, sl, pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_vox_mindist_2_all_A_mask_vox.nii.gz', profile)
+            save_uncropped(dilated_cogA, aff1, full_shape, sl, pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_COG.nii.gz', profile)
+            save_uncropped(dilated_cogB, aff2, full_shape, sl, pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_COG.nii.gz', profile)
+
+        # save output measures and marker coordinates to a json file, in all output profiles
+        measures = {'mask_A': in1, 'mask_B': in2, 'initial_overlap': wf == 1, \
+            'min_dist_mm': all_min, 'min_dist_A_vox': a_vox_vv, 'min_dist_A_mm': a_vox_mm, \
+            'min_dist_B_vox': b_vox_vv, 'min_dist_B_mm': b_vox_mm, \
+            'COGs_dist_mm': cogs_d, 'COG_A_vox': cog1, 'COG_A_mm': cog1_xyz, 'COG_B_vox': cog2, 'COG_B_mm': cog2_xyz, \
+            'COGA_2_B_min_mm': coga_2b, 'COGA_2_B_vox': ca2bijk, 'COGA_2_B_mm': ca2bxyz, \
+            'COGB_2_A_min_mm': cogb_2a, 'COGB_2_A_vox': cb2aijk, 'COGB_2_A_mm': cb2axyz}
+        if wf == 1:
+            measures.update({'overlap_vox': ov_count, 'overlap_perc_A': ov_perc_mA, 'overlap_perc_B': ov_perc_mB, \
+                'overlap_COG_vox': ov_cog_ijk, 'overlap_COG_mm': ov_cog_xyz, \
+                'overlap_COG_2_A_min_mm': min_AvsOVCOG_d, 'overlap_COG_2_A_vox': ca_vox_vv, 'overlap_COG_2_A_mm': ca_vox_mm, \
+                'overlap_2_COGA_min_mm': min_OV2ACOG_d, 'overlap_2_COGA_vox': cb_vox_vv, 'overlap_2_COGA_mm': cb_vox_mm, \
+                'overlap_2_COGB_min_mm': min_OV2BCOG_d, 'overlap_2_COGB_vox': cc_vox_vv, 'overlap_2_COGB_mm': cc_vox_mm})
+        with open(pwd + '/' + out_n + '_output/' +  out_n + '_output' + nm + '_output_measures.json', 'w') as f:
+            json.dump({k: to_json(v) for k, v in measures.items()}, f, indent=2)
+
+        wait_for_writes()
 
     else:         
         print('the affines of the inputs are not matching, please double check, exiting')
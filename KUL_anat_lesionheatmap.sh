@@ -16,6 +16,15 @@ fix_im="$kul_main_dir/atlasses/Ganzetti2014/mni_icbm152_t1_tal_nlin_sym_09a.nii"
 
 # FUNCTIONS --------------
 
+# function KUL_heatmap: sum the maps (list in $1) into the heatmap $2
+#  the maps are passed in a file (not on the command line) and the sums are kept in
+#  a state file, so only new maps are read next time (also gives _freq and _N maps)
+function KUL_heatmap {
+    local maps_file=${2%.nii.gz}_maps.txt
+    printf '%s\n' $1 > $maps_file
+    KUL_lesion_accumulator.py -n $ncpu -l $maps_file -o $2
+}
+
 # function Usage
 function Usage {
 
@@ -137,9 +146,24 @@ fi
 
 # STEP 1 - SETUP
 heat1=""
+heat1a=""
 heat2=""
 heat3=""
 heat4=""
+maps1=()
+maps1a=()
+maps2=()
+maps3=()
+maps4=()
+mni=/usr/local/KUL_apps/KUL_NIS/atlasses/Ganzetti2014/mni_icbm152_t1_tal_nlin_sym_09a.nii
+mni_label=mni_icbm152_t1_tal_nlin_sym_09a
+
+kulderivativesdir=BIDS/derivatives/KUL_compute/KUL_anat_lesionheatmap
+mkdir -p $kulderivativesdir
+
+# the lesion maps are warped to MNI afterwards, all maps of a participant at once (see KUL_warp_maps.py)
+warp_manifest=$kulderivativesdir/warp_manifest.tsv
+printf 'job\treference\ttransforms\tinterpolation\tinput\toutput\n' > $warp_manifest
 
 for participant in ${participants[@]}; do
 
@@ -199,11 +223,23 @@ for participant in ${participants[@]}; do
     fi
 
     KUL_anat_register.sh \
-        -t /usr/local/KUL_apps/KUL_NIS/atlasses/Ganzetti2014/mni_icbm152_t1_tal_nlin_sym_09a.nii \
+        -t $mni \
         -s $T1w \
         -d $wd \
-        -w -m 1 -i 2 \
-        -o "$lesion1 $lesion1a $lesion2 $lesion3 $lesion4"
+        -w -m 1 -i 2
+
+    T1w_label_tmp=$(basename $T1w)
+    outputwarp=$wd/${T1w_label_tmp%%.*}_warp2_${mni_label}
+    if [ -f ${outputwarp}1Warp.nii.gz ]; then
+        for lesion in $lesion1 $lesion1a $lesion2 $lesion3 $lesion4; do
+            if [ -f $lesion ]; then
+                lesion_label_tmp=$(basename $lesion)
+                printf '%s\t%s\t%s\t%s\t%s\t%s\n' sub-${participant} $mni \
+                    "${outputwarp}1Warp.nii.gz ${outputwarp}0GenericAffine.mat" NearestNeighbor \
+                    $lesion $wd/${lesion_label_tmp%%.*}_reg2_${mni_label}.nii.gz >> $warp_manifest
+            fi
+        done
+    fi
 
     map_d="BIDS/derivatives/KUL_compute/sub-${participant}/KUL_anat_register_mni/"
     map1="$map_d/sub-${participant}_${lesion1_label}_reg2_mni_icbm152_t1_tal_nlin_sym_09a.nii.gz"
@@ -211,7 +247,24 @@ for participant in ${participants[@]}; do
     map2="$map_d/sub-${participant}_${lesion2_label}_reg2_mni_icbm152_t1_tal_nlin_sym_09a.nii.gz"
     map3="$map_d/sub-${participant}_${lesion3_label}_reg2_mni_icbm152_t1_tal_nlin_sym_09a.nii.gz"
     map4="$map_d/sub-${participant}_${lesion4_label}_reg2_mni_icbm152_t1_tal_nlin_sym_09a.nii.gz"
-    
+    maps1+=($map1)
+    maps1a+=($map1a)
+    maps2+=($map2)
+    maps3+=($map3)
+    maps4+=($map4)
+
+done
+
+# STEP 2 - warp the lesion maps of all participants to MNI (only new or changed maps)
+KUL_warp_maps.py -n $ncpu $warp_manifest
+
+for i in ${!maps1[@]}; do
+    map1=${maps1[$i]}
+    map1a=${maps1a[$i]}
+    map2=${maps2[$i]}
+    map3=${maps3[$i]}
+    map4=${maps4[$i]}
+
     if [ -f $map1 ]; then 
         heat1="$heat1 $map1 "
     fi
@@ -230,14 +283,13 @@ for participant in ${participants[@]}; do
 
 done
 
-kulderivativesdir=BIDS/derivatives/KUL_compute/KUL_anat_lesionheatmap
-mkdir -p $kulderivativesdir
-mrmath $heat1 sum $kulderivativesdir/lesionheatmap_lesion_and_cavity1.nii.gz -force
+# STEP 3 - the heatmaps
+KUL_heatmap "$heat1" $kulderivativesdir/lesionheatmap_lesion_and_cavity1.nii.gz
 echo $heat1a
-mrmath $heat1a sum $kulderivativesdir/lesionheatmap_lesion_and_cavity2.nii.gz -force
-mrmath $heat2 sum $kulderivativesdir/lesionheatmap_hdglio_lesion_perilesional_tissue.nii.gz -force
-mrmath $heat3 sum $kulderivativesdir/lesionheatmap_hdglio_lesion_total.nii.gz -force
-mrmath $heat4 sum $kulderivativesdir/lesionheatmap_resseg_cavity_only.nii.gz -force
+KUL_heatmap "$heat1a" $kulderivativesdir/lesionheatmap_lesion_and_cavity2.nii.gz
+KUL_heatmap "$heat2" $kulderivativesdir/lesionheatmap_hdglio_lesion_perilesional_tissue.nii.gz
+KUL_heatmap "$heat3" $kulderivativesdir/lesionheatmap_hdglio_lesion_total.nii.gz
+KUL_heatmap "$heat4" $kulderivativesdir/lesionheatmap_resseg_cavity_only.nii.gz
 
 
 echo "Finished"
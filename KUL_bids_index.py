@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Index the images of a BIDS directory in a SQLite database next to it
+# Used by KUL_BIDS_clean.py and KUL_bids_summary to query the metadata of the
+# images without opening every json sidecar and image again.
+# Per image the json sidecar is read once and of the nifti only the header
+# (dimensions and voxel sizes, no voxel data). The index is updated
+# incrementally: only images of which the nifti or json changed (size or
+# mtime) are read again.
+#
+# Example: all T1w of sub-X with MRAcquisitionType and SeriesNumber
+#   KUL_bids_index.py BIDS -s sub-X -t T1w -f MRAcquisitionType SeriesNumber
+# or from python
+#   KUL_bids_index.updateIndex('BIDS')
+#   KUL_bids_index.query('BIDS', subject='sub-X', suffix='T1w', fields=['MRAcquisitionType', 'SeriesNumber'])
+
+import os
+import json
+import argparse
+import sqlite3
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+
+
+# the columns of an image in the index (besides the sidecar)
+index_columns = ['path', 'subject', 'session', 'datatype', 'suffix',
+                 'nii_size', 'nii_mtime', 'json_mtime', 'ndim', 'size', 'spacing']
+
+
+# a function to get the index file of a bids directory, e.g. BIDS -> BIDS_KUL_bids_index.sqlite
+def getIndexFile(bids_dir):
+    return os.path.abspath(bids_dir).rstrip(os.sep) + '_KUL_bids_index.sqlite'
+
+# a function to connect to (and if needed create) the index
+def openIndex(bids_dir):
+    con = sqlite3.connect(getIndexFile(bids_dir), timeout=600)
+    con.execute('CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, subject TEXT, session TEXT, '
+                'datatype TEXT, suffix TEXT, nii_size INTEGER, nii_mtime INTEGER, json_mtime INTEGER, '
+                'ndim INTEGER, size TEXT, spacing TEXT, sidecar TEXT)')
+    con.execute('CREATE INDEX IF NOT EXISTS images_subject ON images (subject, suffix)')
+    return con
+
+# a function to get the sidecar of an image
+def getJsonFile(nii_file):
+    return nii_file[:-len('.nii.gz')] + '.json' if nii_file.endswith('.nii.gz') \
+        else os.path.splitext(nii_file)[0] + '.json'
+
+# a function to get subject, session, datatype and suffix from the path of an image, relative to the bids dir
+# e.g. sub-P001/ses-tp01/anat/sub-P001_ses-tp01_run-1_T1w.nii.gz -> sub-P001, ses-tp01, anat, T1w
+def getEntities(path):
+    parts = path.split(os.sep)
+    subject = parts[0]
+    session = parts[1] if len(parts) > 3 and parts[1].startswith('ses-') else ''
+    datatype = parts[-2] if len(parts) > 1 else ''
+    name = parts[-1].split('.')[0]
+    suffix = name.split('_')[-1]
+    return subject, session, datatype, suffix
+
+# a function to read the json sidecar and the nifti header of one image
+def readImage(bids_dir, path, stat):
+    nii_file = os.path.join(bids_dir, path)
+    json_file = getJsonFile(nii_file)
+    sidecar = {}
+    if os.path.exists(json_file):
+        try:
+            with open(json_file) as f:
+                sidecar = json.load(f)
+        except ValueError:
+            print('Could not read ' + json_file)
+    try:
+        header = nib.load(nii_file).header
+        size = [int(d) for d in header.get_data_shape()]
+        spacing = [float(z) for z in header.get_zooms()]
+    except Exception:
+        print('Could not read the header of ' + nii_file)
+        size = []
+        spacing = []
+    return [path] + list(getEntities(path)) + list(stat) + \
+        [len(size), json.dumps(size), json.dumps(spacing), json.dumps(sidecar)]
+
+# a function to bring the index up to date with the bids directory
+# returns the subjects of which images were added, changed or removed
+def updateIndex(bids_dir, nthreads=os.cpu_count()):
+    con = openIndex(bids_dir)
+    known = {row[0]: tuple(row[1:]) for row in con.execute('SELECT path, nii_size, nii_mtime, json_mtime FROM images')}
+    found = {}
+    for root, dirs, files in os.walk(bids_dir):
+        dirs[:] = sorted(d for d in dirs if d not in ('derivatives', 'sourcedata', 'code') and not d.startswith('.'))
+        for f in sorted(files):
+            if not f.startswith('sub-') or not (f.endswith('.nii.gz') or f.endswith('.nii')):
+                continue
+            nii_file = os.path.join(root, f)
+            json_file = getJsonFile(nii_file)
+            st = os.stat(nii_file)
+            json_mtime = os.stat(json_file).st_mtime_ns if os.path.exists(json_file) else 0
+            found[os.path.relpath(nii_file, bids_dir)] = (st.st_size, st.st_mtime_ns, json_mtime)
+    changed = [path for path in found if known.get(path) != found[path]]
+    removed = [path for path in known if path not in found]
+
+    # the sidecars and headers are read concurrently
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as pool:
+        rows = list(pool.map(lambda path: readImage(bids_dir, path, found[path]), changed))
+    with con:
+        con.executemany('DELETE FROM images WHERE path = ?', [(path,) for path in removed])
+        con.executemany('INSERT OR REPLACE INTO images VALUES (' + ', '.join(['?'] * (len(index_columns) + 1)) + ')',
+                        rows)
+    con.close()
+    return sorted(set(getEntities(path)[0] for path in changed + removed))
+
+# a function to query the index; returns a list of dicts with the index columns (path relative
+# to the bids dir, size and spacing as lists) and the requested sidecar fields (None if absent)
+def query(bids_dir, subject=None, session=None, datatype=None, suffix=None, fields=(), sidecar=False):
+    con = openIndex(bids_dir)
+    columns = ', '.join(index_columns)
+    select = 'SELECT ' + columns + ', ' + ''.join("json_extract(sidecar, ?), " for field in fields) + \
+        'sidecar FROM images'
+    params = ['$."' + field + '"' for field in fields]
+    conditions = []
+    for column, value in (('subject', subject), ('session', session), ('datatype', datatype), ('suffix', suffix)):
+        if value is not None:
+            conditions.append(column + ' = ?')
+            params.append(value)
+    if conditions:
+        select += ' WHERE ' + ' AND '.join(conditions)
+    images = []
+    for row in con.execute(select + ' ORDER BY path', params):
+        image = dict(zip(index_columns, row))
+        image['size'] = json.loads(image['size'])
+        image['spacing'] = json.loads(image['spacing'])
+        for i, field in enumerate(fields):
+            image[field] = row[len(index_columns) + i]
+        if sidecar:
+            image['sidecar'] = json.loads(row[-1])
+        images.append(image)
+    con.close()
+    return images
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index and query the images of a BIDS directory",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('bidsdir', nargs='?', default='BIDS', help='bids directory')
+    parser.add_argument('-s', '--subject', help='subject, e.g. sub-P001')
+    parser.add_argument('-e', '--session', help='session, e.g. ses-tp01')
+    parser.add_argument('-d', '--datatype', help='datatype, e.g. anat')
+    parser.add_argument('-t', '--suffix', help='suffix, e.g. T1w')
+    parser.add_argument('-f', '--fields', nargs='+', default=[], help='sidecar fields to show, e.g. SeriesNumber')
+    parser.add_argument('-n', '--ncpu', type=int, default=os.cpu_count(), help='number of threads reading files')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.bidsdir):
+        print(args.bidsdir + ' does not exist')
+        exit(1)
+    updateIndex(args.bidsdir, args.ncpu)
+    for image in query(args.bidsdir, args.subject, args.session, args.datatype, args.suffix, args.fields):
+        print('\t'.join([image['path']] + ['' if image[field] is None else str(image[field]) for field in args.fields]))
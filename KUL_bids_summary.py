@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Creates a summary of information of the BIDS directory
+# (python version of KUL_bids_summary.sh, with the same columns in BIDS_info.tsv)
+# Information gathered is:
+#  - subjects
+#  - sessions
+#  - available data (T1w, T2w, FLAIR, func, dwi)
+#
+# Unlike the .sh version, which summarises every *nii.gz file under the bids
+# directory, only the raw data are summarised (as indexed by KUL_bids_index):
+# images named sub-*.nii.gz or sub-*.nii, not those in derivatives, sourcedata,
+# code or hidden directories. So .nii images are added and derivatives are left out.
+#
+# The json sidecars and the nifti headers are read through KUL_bids_index:
+# the sidecars are parsed once, the dimensions come from the nifti header and
+# only images that changed since the last summary are read again.
+#
+# Requires nibabel
+
+import os
+import argparse
+import KUL_bids_index
+
+# Get commandline
+parser = argparse.ArgumentParser(description="Creates a summary of information of the BIDS directory",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-b', '--bids_dir', default='BIDS', help='bids directory')
+parser.add_argument('-o', '--output', default='BIDS_info.tsv', help='output file')
+parser.add_argument('-n', '--ncpu', type=int, default=os.cpu_count(), help='number of threads reading files')
+parser.add_argument('-v', '--verbose', action='store_true', help='print the information of every image')
+args = parser.parse_args()
+
+# columns of the summary and the sidecar fields they come from
+columns = ['MRI-scan', 'Subject', 'Session', 'Type', 'Scan', 'Site', 'Manufacturer', 'Model', 'Software', 'Coil',
+           'MagneticFieldStrength', 'SeriesDescription', 'SeriesNumber', 'AcquisitionType', 'TE', 'TR', 'TI',
+           'DIM', 'Dim_x', 'Dim_y', 'Dim_z', 'Dynamics', 'ETL']
+sidecar_fields = {'Site': 'StationName',
+        'Manufacturer': 'Manufacturer',
+        'Model': 'ManufacturersModelName',
+        'Software': 'SoftwareVersions',
+        'Coil': 'CoilString',
+        'MagneticFieldStrength': 'MagneticFieldStrength',
+        'SeriesDescription': 'SeriesDescription',
+        'SeriesNumber': 'SeriesNumber',
+        'AcquisitionType': 'MRAcquisitionType',
+        'TE': 'EchoTime',
+        'TR': 'RepetitionTime',
+        'TI': 'InversionTime',
+        'ETL': 'EchoTrainLength'}
+
+
+# a function to write a value in the summary (which is separated by ', ')
+def formatValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = ' '.join(str(v) for v in value)
+    return str(value).replace(',', ';')
+
+# a function to get the row of the summary of an image
+def getRow(image):
+    size = image['size']
+    row = {'MRI-scan': os.path.join(args.bids_dir, image['path']),
+           'Subject': image['subject'],
+           'Session': image['session'],
+           'Type': image['datatype'],
+           'Scan': image['suffix'],
+           'DIM': image['ndim'],
+           'Dim_x': size[0] if len(size) > 0 else '',
+           'Dim_y': size[1] if len(size) > 1 else '',
+           'Dim_z': size[2] if len(size) > 2 else '',
+           'Dynamics': size[3] if len(size) > 3 else ''}
+    for column in sidecar_fields:
+        row[column] = image['sidecar'].get(sidecar_fields[column])
+    return [formatValue(row[column]) for column in columns]
+
+
+if not os.path.exists(args.bids_dir):
+    print(args.bids_dir + ' does not exist')
+    exit(1)
+
+# find all images in the bids directory (only the changed ones are read)
+changed = KUL_bids_index.updateIndex(args.bids_dir, args.ncpu)
+print('Subjects with new or changed images: ' + str(len(changed)))
+images = KUL_bids_index.query(args.bids_dir, sidecar=True)
+print('Number of nifti data in the BIDS folder: ' + str(len(images)))
+
+tmp_output = args.output + '.tmp'
+with open(tmp_output, 'w') as f:
+    f.write(', '.join(columns) + '\n')
+    for image in images:
+        row = getRow(image)
+        if args.verbose:
+            for column, value in zip(columns, row):
+                print(column + ': ' + value)
+        f.write(', '.join(row) + '\n')
+os.replace(tmp_output, args.output)
@@ -4,6 +4,10 @@
 
 import os
 import argparse
+import json
+import tempfile
+import SimpleITK as sitk
+import KUL_dcm_index
 
 # Get commandline
 parser = argparse.ArgumentParser(description="Convert dicom to nifti",
@@ -17,6 +21,8 @@ parser.add_argument('-i', '--inputtype', nargs='+', help='inputtype, e.g. M_FFE'
 parser.add_argument('-o', '--outputtype', nargs='+', help='outputtype, e.g. phase')
 parser.add_argument('-a', '--acquisition', nargs='+', help='acquisition, e.g. ap')
 parser.add_argument('-e', '--pe_direction', nargs='+', help='phase encoding direction, e.g. j-')
+parser.add_argument('--indexed', action='store_true',
+                    help='the index of the dicom dir is up to date, only read it (as KUL_multisubjects_dcm2bids.py does)')
 
 args = parser.parse_args()
 
@@ -41,13 +47,51 @@ print(nii_parts)
 '''
 
 # tags to get from donor
-# a function to get tags
-def getDicomTag(tag):
-    cmd = 'dcminfo -tag ' + tag + ' ' + '\"' + donor_dcm[0] +'\"'
-    #print(cmd)
-    out = os.popen(cmd).read().strip()
-    #print(out)
-    return out.split(' ')[1]
+# headers that were read before, keyed by path and checked on size and mtime
+header_cache_file = '.KUL_dcm2bids_headers.json'
+
+# a function to get all tags at once from the header (private tags included)
+def readDicomTags(dcm_file, tags):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(dcm_file)
+    reader.LoadPrivateTagsOn()
+    reader.ReadImageInformation()
+    values = {}
+    for key in tags:
+        tag = tags[key].lower().replace(' ', '|')
+        if reader.HasMetaDataKey(tag):
+            values[key] = reader.GetMetaData(tag)
+    return values
+
+# a function to get tags, from the cache if the file did not change
+def getDicomTags(dcm_file, tags):
+    if os.path.exists(header_cache_file):
+        with open(header_cache_file) as f:
+            cache = json.load(f)
+    else:
+        cache = {}
+    st = os.stat(dcm_file)
+    path = os.path.abspath(dcm_file)
+    entry = cache.get(path)
+    if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns \
+            and all(key in entry['tags'] or key in entry['missing'] for key in tags):
+        return entry['tags']
+    values = readDicomTags(dcm_file, tags)
+    cache[path] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'tags': values,
+                   'missing': [key for key in tags if key not in values]}
+    tmp_file = header_cache_file + '.' + str(os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp_file, header_cache_file)
+    return values
+
+# a function to format a tag as dcminfo did: the first value, up to the first space,
+# and numbers with 6 significant digits
+def formatDicomTag(key, value):
+    value = value.strip().split('\\')[0].strip()
+    if key in numeric_tags:
+        return '%g' % float(value)
+    return value.split(' ')[0]
 
 # define tags to read from the donor dcm
 dict_tags = {'Modality': '0008 0060', \
@@ -68,13 +112,25 @@ dict_tags = {'Modality': '0008 0060', \
         'WaterFatShift': '2001 1022', \
         'EPIFactor': '2001 1013', \
         'Rows': '0028 0010'}
+numeric_tags = ['MagneticFieldStrength', 'ImagingFrequency', 'WaterFatShift', 'EPIFactor', 'Rows']
+# the tags needed for the echo spacing, the conversion stops without them
+required_tags = ['ImagingFrequency', 'WaterFatShift', 'EPIFactor', 'Rows']
 
 # get the relevant tags
+if not os.path.exists(donor_dcm[0]):
+    print(donor_dcm[0] + ' does not exist')
+    exit(1)
+dcm_values = getDicomTags(donor_dcm[0], dict_tags)
 dict_dcm = {}
 for key in dict_tags:
     print(key)
     print(dict_tags[key])
-    dict_tags[key] = getDicomTag(dict_tags[key])
+    if key not in dcm_values or not dcm_values[key].strip():
+        print(key + ' not found in ' + donor_dcm[0])
+        if key in required_tags:
+            exit(1)
+        continue
+    dict_tags[key] = formatDicomTag(key, dcm_values[key])
     #print(dict_tags[key])
     dict_dcm.update({key : dict_tags[key]})
 #print(dict_dcm)
@@ -118,11 +174,18 @@ if not os.path.exists(dcm_dir):
     print(dcm_dir + ' does not exist')
     exit(1)
 
+# index the series of the dicom dir (only new or changed files are read)
+if not args.indexed:
+    KUL_dcm_index.updateIndex(dcm_dir)
+
 #nii_dir = os.path.join('BIDS/sub-' + participant, 'dwi')
 nii_dir = '.'
 if not os.path.exists(nii_dir):
    os.makedirs(nii_dir)
 
+# set when a part could not be converted
+failed = False
+
 #for i, dcm_serie in enumerate(dcm_series):
 i = 0
 dcm_serie = dcm_series
@@ -155,19 +218,43 @@ for j, nii_part in enumerate(nii_parts):
 
     # check if we need to check on a type (e.g. M_FFE) too & set the output type if not specified
     if dcm_types:
-        search_type = " | grep " + dcm_types[j]    
+        search_type = dcm_types[j]
     else:
-        search_type = ""
-
-    cmd = "echo q | mrinfo \"" + str(dcm_dir) + "\" 2>&1 | grep " + str(dcm_serie[0]) + \
-        search_type + " | awk '{print $1}' | mrconvert " + \
-        " \"" + str(dcm_dir) + "\" " +  \
-        additional_properties + ' ' + \
-        " -json_export " + nii_json + ' ' + \
-        export_grad_fls + ' ' + \
-        property_pe + ' ' + \
-        nii_nii + ' -force'
-    print(cmd)
-    #exit()
-    out = os.popen(cmd).read().strip()
-    print(out)
+        search_type = None
+
+    # get the files of the series from the index and give mrconvert only those
+    # (linked in a temporary dir)
+    dcm_files = KUL_dcm_index.getSeriesFiles(dcm_dir, dcm_serie[0], search_type)
+    if not dcm_files:
+        print('No series ' + str(dcm_serie[0]) + (' of type ' + search_type if search_type else '') + \
+            ' in ' + dcm_dir)
+        failed = True
+        continue
+    # the frames of a multi-frame file are not indexed, mrinfo selects those of the type
+    multi_frame = search_type and KUL_dcm_index.isMultiFrame(dcm_dir, dcm_files)
+    with tempfile.TemporaryDirectory(prefix='KUL_dcm2bids_') as series_dir:
+        for n, dcm_file in enumerate(dcm_files):
+            os.symlink(os.path.abspath(dcm_file), os.path.join(series_dir, str(n).rjust(6, '0') + '.dcm'))
+
+        if multi_frame:
+            select_type = "echo q | mrinfo \"" + series_dir + "\" 2>&1 | grep " + search_type + \
+                " | awk '{print $1}' | "
+        else:
+            select_type = ""
+        cmd = select_type + "mrconvert " + \
+            " \"" + series_dir + "\" " +  \
+            additional_properties + ' ' + \
+            " -json_export " + nii_json + ' ' + \
+            export_grad_fls + ' ' + \
+            property_pe + ' ' + \
+            nii_nii + ' -force'
+        print(cmd)
+        #exit()
+        pipe = os.popen(cmd)
+        out = pipe.read().strip()
+        print(out)
+        if pipe.close():
+            failed = True
+
+if failed:
+    exit(1)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Index the series of a dicom directory in a SQLite database next to it
+# Used by KUL_dcm2bids.py to get the files of a series without letting mrinfo
+# scan the whole dicom directory for every conversion.
+# The index is updated incrementally: only new files or files with a changed
+# size or mtime are read again (header only).
+# The index holds a row per file, not per frame: the frames of an enhanced
+# multi-frame file (e.g. the magnitude and phase of a Philips series in one
+# file) cannot be selected on their image type here, see getSeriesFiles.
+
+import os
+import argparse
+import sqlite3
+import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor
+
+
+# tags stored for every file
+index_tags = {'series_uid': '0020|000e',
+        'series_number': '0020|0011',
+        'series_description': '0008|103e',
+        'protocol_name': '0018|1030',
+        'image_type': '0008|0008',
+        'acquisition_type': '0018|0023',
+        'pe_direction': '0018|1312',
+        'instance_number': '0020|0013',
+        'number_of_frames': '0028|0008'}
+
+# tags stored as an integer
+int_tags = ('series_number', 'instance_number', 'number_of_frames')
+
+
+# a function to get the index file of a dicom directory, e.g. DICOM -> DICOM_KUL_dcm_index.sqlite
+def getIndexFile(dcm_dir):
+    return os.path.abspath(dcm_dir).rstrip(os.sep) + '_KUL_dcm_index.sqlite'
+
+# a function to connect to (and if needed create) the index; a read only connection
+# neither creates nor changes it, so it can be used while other processes read it
+def openIndex(dcm_dir, readonly=False):
+    if readonly:
+        return sqlite3.connect('file:' + getIndexFile(dcm_dir) + '?mode=ro', uri=True, timeout=600)
+    con = sqlite3.connect(getIndexFile(dcm_dir), timeout=600)
+    # an index made with other tags is made again
+    columns = [row[1] for row in con.execute('PRAGMA table_info(files)')]
+    if columns and columns != ['path', 'size', 'mtime'] + list(index_tags):
+        con.execute('DROP TABLE files')
+    con.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, ' +
+                ', '.join(key + (' INTEGER' if key in int_tags else ' TEXT') for key in index_tags) + ')')
+    con.execute('CREATE INDEX IF NOT EXISTS files_series ON files (series_number, image_type)')
+    return con
+
+# a function to read the tags of one file; files that are not dicom images get None for all tags
+def readHeader(dcm_file):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(dcm_file)
+    reader.SetImageIO('GDCMImageIO')
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return [None] * len(index_tags)
+    values = []
+    for key in index_tags:
+        value = None
+        if reader.HasMetaDataKey(index_tags[key]):
+            value = reader.GetMetaData(index_tags[key]).strip()
+            if key in int_tags:
+                value = int(value) if value.lstrip('-').isdigit() else None
+        values.append(value)
+    return values
+
+# a function to bring the index up to date with the dicom directory
+def updateIndex(dcm_dir, nthreads=os.cpu_count()):
+    con = openIndex(dcm_dir)
+    known = {path: (size, mtime) for path, size, mtime in con.execute('SELECT path, size, mtime FROM files')}
+    found = {}
+    for root, dirs, files in os.walk(dcm_dir):
+        dirs.sort()
+        for f in sorted(files):
+            st = os.stat(os.path.join(root, f))
+            found[os.path.relpath(os.path.join(root, f), dcm_dir)] = (st.st_size, st.st_mtime_ns)
+    changed = [path for path in found if known.get(path) != found[path]]
+    removed = [path for path in known if path not in found]
+
+    # the headers are read concurrently (SimpleITK releases the GIL while reading)
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as pool:
+        headers = list(pool.map(lambda path: readHeader(os.path.join(dcm_dir, path)), changed))
+    with con:
+        con.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in removed])
+        con.executemany('INSERT OR REPLACE INTO files VALUES (' + ', '.join(['?'] * (len(index_tags) + 3)) + ')',
+                        [[path, found[path][0], found[path][1]] + header for path, header in zip(changed, headers)])
+    print('Index of ' + dcm_dir + ': ' + str(len(found)) + ' files, ' + str(len(changed)) + ' (re)read, ' +
+          str(len(removed)) + ' removed')
+    con.close()
+
+# a function to list the series in the index (one line per series and image type)
+def getSeries(dcm_dir):
+    con = openIndex(dcm_dir, readonly=True)
+    series = con.execute('SELECT series_number, image_type, series_description, protocol_name, acquisition_type, '
+                         'pe_direction, count(*) FROM files WHERE series_uid IS NOT NULL '
+                         'GROUP BY series_uid, image_type ORDER BY series_number, series_uid, image_type').fetchall()
+    con.close()
+    return series
+
+# a function to get the files of a series, optionally only those with an image type containing
+# image_type (e.g. M_FFE); when several series/image types match, the first one is used.
+# Multi-frame files are not selected on image type, as their frames can be of different types;
+# the frames of the type are then to be selected from the files (see isMultiFrame)
+def getSeriesFiles(dcm_dir, series_number, image_type=None):
+    con = openIndex(dcm_dir, readonly=True)
+    query = 'SELECT series_uid, image_type, path FROM files WHERE series_number = ?'
+    params = [int(series_number)]
+    if image_type:
+        query += ' AND (instr(image_type, ?) > 0 OR number_of_frames > 1)'
+        params.append(image_type)
+    rows = con.execute(query + ' ORDER BY series_uid, image_type, instance_number, path', params).fetchall()
+    con.close()
+    if not rows:
+        return []
+    return [os.path.join(dcm_dir, path) for uid, itype, path in rows if (uid, itype) == rows[0][:2]]
+
+# a function to check whether any of the files (from getSeriesFiles) holds more than one frame
+def isMultiFrame(dcm_dir, dcm_files):
+    con = openIndex(dcm_dir, readonly=True)
+    paths = [os.path.relpath(dcm_file, dcm_dir) for dcm_file in dcm_files]
+    multi_frame = any(con.execute('SELECT number_of_frames > 1 FROM files WHERE path = ?', (path,)).fetchone()[0]
+                      for path in paths)
+    con.close()
+    return multi_frame
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index the series of a dicom directory",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('dicomdir', help='dicom input directory')
+    parser.add_argument('-n', '--ncpu', type=int, default=os.cpu_count(), help='number of threads reading headers')
+    parser.add_argument('-l', '--list', action='store_true', help='list the series in the index')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.dicomdir):
+        print(args.dicomdir + ' does not exist')
+        exit(1)
+    updateIndex(args.dicomdir, args.ncpu)
+    if args.list:
+        for series in getSeries(args.dicomdir):
+            print('\t'.join('' if v is None else str(v) for v in series))
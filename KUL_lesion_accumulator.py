@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Sum lesion maps (in the same space, e.g. MNI) into a lesion frequency map
+# Used by KUL_anat_lesionheatmap.sh and studies/cappelle2021/KUL_warp_lesions2mni.py
+# instead of mrmath ... sum, which needs all maps on one command line.
+#
+# The maps are read one at a time (decompressed by a few threads) and added to
+# running sums, so the memory does not depend on the number of maps.
+# Outputs, e.g. for -o heatmap.nii.gz:
+#   heatmap.nii.gz        sum of the maps (as mrmath sum)
+#   heatmap_freq.nii.gz   percentage of the maps with a lesion (> 0) in the voxel
+#   heatmap_N.nii.gz      number of maps with a value (not NaN) in the voxel
+# The sums are kept in a state file (default heatmap_state.npz); a next run only
+# reads the maps that are new. When a map changed or is no longer given, all
+# maps are read again.
+#
+# Example:
+#   KUL_lesion_accumulator.py -o heatmap.nii.gz sub-*/lesion_MNI.nii.gz
+# or with a file with one map per line
+#   KUL_lesion_accumulator.py -o heatmap.nii.gz -l maps.txt
+
+import os
+import json
+import argparse
+from collections import deque
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+
+
+# a function to get the names of the outputs
+def getOutputs(output):
+    prefix = output[:-len('.nii.gz')] if output.endswith('.nii.gz') else os.path.splitext(output)[0]
+    ext = output[len(prefix):]
+    return {'sum': output, 'freq': prefix + '_freq' + ext, 'N': prefix + '_N' + ext, 'state': prefix + '_state.npz'}
+
+# a function to get the size and mtime of the maps
+def getFingerprints(maps):
+    fingerprints = {}
+    for lesion_map in maps:
+        st = os.stat(lesion_map)
+        fingerprints[os.path.abspath(lesion_map)] = [st.st_size, st.st_mtime_ns]
+    return fingerprints
+
+# a function to read a lesion map (the first volume of a 4D map)
+def readMap(lesion_map):
+    img = nib.load(lesion_map)
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3] + (-1,))[..., 0]
+    return img, data
+
+# a function to read the maps with nthreads, but with at most 2 * nthreads maps in memory
+def streamMaps(maps, nthreads):
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as pool:
+        pending = deque()
+        for lesion_map in maps:
+            pending.append((lesion_map, pool.submit(readMap, lesion_map)))
+            if len(pending) >= 2 * max(1, nthreads):
+                lesion_map, future = pending.popleft()
+                yield (lesion_map,) + future.result()
+        while pending:
+            lesion_map, future = pending.popleft()
+            yield (lesion_map,) + future.result()
+
+# a function to load the state, None if there is none
+def loadState(state_file):
+    if not os.path.exists(state_file):
+        return None
+    with np.load(state_file) as f:
+        state = {key: f[key] for key in f.files}
+    state['fingerprints'] = json.loads(str(state['fingerprints']))
+    return state
+
+# a function to save the state (atomic)
+def saveState(state, state_file):
+    tmp_file = state_file + '.tmp.npz'
+    np.savez(tmp_file, sum=state['sum'], count=state['count'], N=state['N'], affine=state['affine'],
+             fingerprints=json.dumps(state['fingerprints']))
+    os.replace(tmp_file, state_file)
+
+# a function to add the maps to the state (a new state if state is None)
+def accumulate(maps, state=None, nthreads=4):
+    for lesion_map, img, data in streamMaps(maps, nthreads):
+        if state is None:
+            state = {'sum': np.zeros(data.shape, dtype=np.float32),
+                     'count': np.zeros(data.shape, dtype=np.uint16),
+                     'N': np.zeros(data.shape, dtype=np.uint16),
+                     'affine': img.affine,
+                     'fingerprints': {}}
+        if data.shape != state['sum'].shape or not np.allclose(img.affine, state['affine'], atol=1e-3):
+            raise ValueError(lesion_map + ' is not in the same space as the other maps')
+        valid = ~np.isnan(data)
+        state['sum'] += np.where(valid, data, 0)
+        state['count'] += data > 0
+        state['N'] += valid
+        print('Added ' + lesion_map)
+    return state
+
+# a function to sum the maps into output, using and updating the saved state
+def updateHeatmap(maps, output, nthreads=4):
+    outputs = getOutputs(output)
+    fingerprints = getFingerprints(maps)
+    state = loadState(outputs['state'])
+    if state is not None and any(fingerprints.get(m) != state['fingerprints'][m] for m in state['fingerprints']):
+        print('Maps changed or were removed since ' + outputs['state'] + ', reading all maps again')
+        state = None
+    known = state['fingerprints'] if state is not None else {}
+    new_maps = [m for m in maps if os.path.abspath(m) not in known]
+    print(str(len(maps) - len(new_maps)) + ' maps already in ' + outputs['sum'] + ', adding ' + str(len(new_maps)))
+    state = accumulate(new_maps, state, nthreads)
+    if state is None:
+        print('No maps to sum')
+        return None
+    state['fingerprints'] = {m: fingerprints[m] for m in sorted(set(known) | set(fingerprints))}
+    saveState(state, outputs['state'])
+
+    freq = np.zeros(state['sum'].shape, dtype=np.float32)
+    np.divide(100 * state['count'].astype(np.float32), state['N'], out=freq, where=state['N'] > 0)
+    for key, data in (('sum', state['sum']), ('freq', freq), ('N', state['N'])):
+        nib.save(nib.Nifti1Image(data, state['affine']), outputs[key])
+    return outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sum lesion maps into a lesion frequency map",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('maps', nargs='*', help='lesion maps')
+    parser.add_argument('-o', '--output', required=True, help='output sum (also _freq, _N and _state.npz)')
+    parser.add_argument('-l', '--list', help='file with lesion maps, one per line')
+    parser.add_argument('-n', '--ncpu', type=int, default=4, help='number of threads reading maps')
+    args = parser.parse_args()
+
+    maps = list(args.maps)
+    if args.list:
+        with open(args.list) as f:
+            maps += [line.strip() for line in f if line.strip()]
+    maps = list(dict.fromkeys(maps))
+    for lesion_map in maps:
+        if not os.path.exists(lesion_map):
+            print(lesion_map + ' does not exist')
+            exit(1)
+    if updateHeatmap(maps, args.output, args.ncpu) is None:
+        exit(1)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# Run KUL_dcm2bids.py for multiple participants and series in parallel
+#
+# The study manifest is a ; separated file with a header, one line per series, e.g.
+#
+#   participant;dicomdir;series;type;parts;inputtypes;acquisition;pe
+#   P001;DICOM/P001;301;T1w;;;;
+#   P001;DICOM/P001;801;dwi;mag,phase;M_SE,PHASE;ap;j-
+#   P001;DICOM/P001;901;dwi;mag;M_SE;pa;j
+#   P002;DICOM/P002;401;T1w;;;;
+#
+# Optional columns: donor (donor dicom, default the first file of the series)
+#                   outdir (default BIDS/sub-<participant>/<anat|dwi|func|fmap>)
+# Lists (parts, inputtypes) are comma separated.
+#
+# Every line is a job running in its own process; the log and the exit code
+# of each job are kept in KUL_LOG/KUL_multisubjects_dcm2bids.py.
+# A job is skipped when its settings and its dicom files (size & mtime) did
+# not change since it last finished without error.
+
+import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import KUL_dcm_index
+
+# Get commandline
+parser = argparse.ArgumentParser(description="Convert dicom to nifti for multiple participants and series",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('manifest', help='study manifest (; separated)')
+parser.add_argument('-b', '--bids_dir', default='BIDS', help='bids output directory')
+parser.add_argument('-n', '--ncpu', type=int, default=os.cpu_count(), help='number of jobs running at the same time')
+parser.add_argument('-f', '--force', action='store_true', help='also run jobs whose inputs did not change')
+args = parser.parse_args()
+
+# where the bids types go
+bids_datatypes = {'dwi': 'dwi', 'bold': 'func', 'sbref': 'func', 'epi': 'fmap'}
+
+kul_main_dir = os.path.dirname(os.path.abspath(__file__))
+log_dir = os.path.join(os.getcwd(), 'KUL_LOG', os.path.basename(__file__))
+
+
+# a function to read the manifest into a list of jobs
+def readManifest(manifest):
+    jobs = []
+    with open(manifest, newline='') as f:
+        for row in csv.DictReader(f, delimiter=';'):
+            row = {key.strip(): (value or '').strip() for key, value in row.items()}
+            job = {'participant': row['participant'],
+                   'dicomdir': os.path.abspath(row['dicomdir']),
+                   'series': row['series'],
+                   'type': row['type'],
+                   'parts': [p for p in row.get('parts', '').split(',') if p] or ['mag'],
+                   'inputtypes': [t for t in row.get('inputtypes', '').split(',') if t],
+                   'acquisition': row.get('acquisition', ''),
+                   'pe': row.get('pe', ''),
+                   'donor': os.path.abspath(row['donor']) if row.get('donor') else '',
+                   'outdir': row.get('outdir') or os.path.join(args.bids_dir, 'sub-' + row['participant'],
+                                                               bids_datatypes.get(row['type'], 'anat'))}
+            job['outdir'] = os.path.abspath(job['outdir'])
+            job['name'] = 'sub-' + job['participant'] + '_series-' + job['series'] + '_' + job['type'] + \
+                ('_acq-' + job['acquisition'] if job['acquisition'] else '')
+            jobs.append(job)
+    return jobs
+
+# a function to get a fingerprint of everything a job depends on
+def getFingerprint(job):
+    dcm_files = []
+    for inputtype in job['inputtypes'] or [None]:
+        dcm_files += KUL_dcm_index.getSeriesFiles(job['dicomdir'], job['series'], inputtype)
+    inputs = []
+    for dcm_file in dcm_files + ([job['donor']] if job['donor'] else []):
+        st = os.stat(dcm_file)
+        inputs.append([dcm_file, st.st_size, st.st_mtime_ns])
+    settings = {key: job[key] for key in job if key != 'name'}
+    return hashlib.sha1(json.dumps([settings, inputs]).encode()).hexdigest(), dcm_files
+
+# a function to run one job, returns (name, exit code, seconds, skipped)
+def runJob(job, nthreads):
+    state_file = os.path.join(log_dir, job['name'] + '.state.json')
+    log_file = os.path.join(log_dir, job['name'] + '.log')
+    fingerprint, dcm_files = getFingerprint(job)
+    if not dcm_files:
+        with open(log_file, 'w') as f:
+            f.write('No dicom files for series ' + job['series'] + ' in ' + job['dicomdir'] + '\n')
+        return job['name'], 1, 0.0, False
+    if not args.force and os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+        if state['fingerprint'] == fingerprint and state['exit_code'] == 0 \
+                and all(os.path.exists(output) for output in state['outputs']):
+            return job['name'], 0, 0.0, True
+
+    donor = job['donor'] or dcm_files[0]
+    cmd = [sys.executable, os.path.join(kul_main_dir, 'KUL_dcm2bids.py'),
+           '--participant', job['participant'],
+           '--dicomdir', job['dicomdir'],
+           '--seriesnumbers', job['series'],
+           '--type', job['type'],
+           '--donor_dcm', donor,
+           '--indexed',
+           '-o'] + job['parts']
+    if job['inputtypes']:
+        cmd += ['-i'] + job['inputtypes']
+    if job['acquisition']:
+        cmd += ['-a', job['acquisition']]
+    if job['pe']:
+        cmd += ['-e', job['pe']]
+
+    os.makedirs(job['outdir'], exist_ok=True)
+    env = dict(os.environ, MRTRIX_NTHREADS=str(nthreads))
+    start = time.time()
+    with open(log_file, 'w') as f:
+        f.write(' '.join(cmd) + '\n')
+        f.flush()
+        exit_code = subprocess.call(cmd, cwd=job['outdir'], env=env, stdout=f, stderr=subprocess.STDOUT)
+    seconds = time.time() - start
+
+    # the outputs are the niftis (and sidecars) of this participant & type written by the job
+    outputs = [os.path.join(job['outdir'], f) for f in sorted(os.listdir(job['outdir']))
+               if f.startswith('sub-' + job['participant']) and ('_' + job['type'] + '.') in f
+               and os.path.getmtime(os.path.join(job['outdir'], f)) >= start]
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'exit_code': exit_code, 'seconds': seconds,
+                   'outputs': outputs}, f, indent=1)
+    os.replace(tmp_file, state_file)
+    return job['name'], exit_code, seconds, False
+
+
+if not os.path.exists(args.manifest):
+    print(args.manifest + ' does not exist')
+    exit(1)
+jobs = readManifest(args.manifest)
+for job in jobs:
+    if not os.path.exists(job['dicomdir']):
+        print(job['dicomdir'] + ' does not exist')
+        exit(1)
+os.makedirs(log_dir, exist_ok=True)
+
+# index every dicom dir once, before the jobs use it (they only read the index)
+for dcm_dir in sorted(set(job['dicomdir'] for job in jobs)):
+    KUL_dcm_index.updateIndex(dcm_dir, args.ncpu)
+
+# run the jobs, the threads of mrconvert are divided over the running jobs
+njobs = max(1, min(args.ncpu, len(jobs)))
+nthreads = max(1, args.ncpu // njobs)
+failed = 0
+with ThreadPoolExecutor(max_workers=njobs) as pool:
+    for name, exit_code, seconds, skipped in pool.map(lambda job: runJob(job, nthreads), jobs):
+        if skipped:
+            print(name + ': up to date, skipped')
+        elif exit_code == 0:
+            print(name + ': done in ' + str(round(seconds, 1)) + ' s')
+        else:
+            failed += 1
+            print(name + ': FAILED (exit code ' + str(exit_code) + '), see ' + os.path.join(log_dir, name + '.log'))
+
+print(str(len(jobs) - failed) + ' of ' + str(len(jobs)) + ' jobs ok')
+exit(1 if failed else 0)
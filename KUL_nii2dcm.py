@@ -10,7 +10,13 @@ import sys
 import time
 import os
 import shutil
+import gzip
+import tempfile
+import threading
+import uuid
+import csv
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Get and check commandline
@@ -19,33 +25,70 @@ parser = argparse.ArgumentParser(description="Convert a nifti or 3d-tiff to dico
 parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
 parser.add_argument("-s", "--seriesdescription")
 parser.add_argument("-n", "--seriesnumber")
-parser.add_argument("nifti", help="nifti or 3d-tiff image")
+parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="number of threads writing slices")
+parser.add_argument("-w", "--window", choices=["max", "minmax", "percentile"], default="max",
+                    help="intensity window mapped onto the 16bit range")
+parser.add_argument("-p", "--percentiles", type=float, nargs=2, default=[0.5, 99.5], metavar=("LOW", "HIGH"),
+                    help="lower and upper percentile of the window when using --window percentile")
+parser.add_argument("-4", "--fourd", choices=["series", "temporal"], default="series",
+                    help="write a 4d input as one series per volume or as one temporal series")
+parser.add_argument("-e", "--enhanced", action="store_true",
+                    help="write a single enhanced MR multi-frame file instead of a file per slice")
+parser.add_argument("-b", "--batch", metavar="MANIFEST",
+                    help="tab separated file with columns nifti, dicomdir and optionally seriesnumber and "
+                         "seriesdescription; all its images are converted against the donor "
+                         "(the nifti and dicomdir arguments are then left out)")
+parser.add_argument("nifti", nargs="?", help="nifti or 3d-tiff image")
 parser.add_argument("donor", help="dicom donor image")
-parser.add_argument("dicomdir", help="dicom output directory")
+parser.add_argument("dicomdir", nargs="?", help="dicom output directory")
 args = parser.parse_args()
 config = vars(args)
 #print(config)
 
+if args.enhanced:
+    # pydicom is only needed to write the enhanced multi-frame object
+    try:
+        import pydicom
+        from pydicom.dataset import Dataset, FileMetaDataset
+        from pydicom.datadict import dictionary_VR
+        from pydicom.valuerep import DSfloat
+    except ImportError:
+        print('Writing enhanced dicom requires pydicom 2.2 or later (pip install pydicom)')
+        exit(1)
+
 
 # Define functions
-def writeSlices(series_tag_values, new_img, out_dir, i):
+# Each writer thread gets its own ImageFileWriter
+thread_data = threading.local()
+
+def getWriter():
+    if not hasattr(thread_data, 'writer'):
+        thread_data.writer = sitk.ImageFileWriter()
+        # Use the study/series/frame of reference information given in the meta-data
+        # dictionary and not the automatically generated information from the file IO
+        thread_data.writer.KeepOriginalImageUIDOn()
+    return thread_data.writer
+
+def writeSlices(series_tag_values, series_uid, new_img, out_dir, i, window=None, first=0):
     image_slice = new_img[:, :, i]
+    if window is not None:
+        image_slice = rescaleSlice(image_slice, window)
+    # Number of the slice in the series (continues over the volumes of a temporal series)
+    n = first + i
 
-    # Tags shared by the series.
-    list(
-        map(
-            lambda tag_value: image_slice.SetMetaData(
-                tag_value[0], tag_value[1]
-            ),
-            series_tag_values,
-        )
-    )
+    # Tags shared by the series (prebuilt once).
+    for tag, value in series_tag_values:
+        image_slice.SetMetaData(tag, value)
 
     # Slice specific tags.
+    # These only depend on the slice index, so the files are the same whichever
+    # worker writes them, and in whichever order.
     #   Instance Creation Date
-    image_slice.SetMetaData("0008|0012", time.strftime("%Y%m%d"))
+    image_slice.SetMetaData("0008|0012", modification_date)
     #   Instance Creation Time
-    image_slice.SetMetaData("0008|0013", time.strftime("%H%M%S"))
+    image_slice.SetMetaData("0008|0013", modification_time)
+    #   SOP Instance UID
+    image_slice.SetMetaData("0008|0018", series_uid + "." + str(n + 1))
 
     # Setting the type to CT so that the slice location is preserved and
     # the thickness is carried over.
@@ -59,13 +102,422 @@ def writeSlices(series_tag_values, new_img, out_dir, i):
         "\\".join(map(str, new_img.TransformIndexToPhysicalPoint((0, 0, i)))),
     )
     #   Instance Number
-    image_slice.SetMetaData("0020|0013", str(i))
+    image_slice.SetMetaData("0020|0013", str(n))
 
     # Write to the output directory and add the extension dcm, to force
     # writing in DICOM format.
-    writer.SetFileName(os.path.join(out_dir, str(i).rjust(6, '0') + ".dcm"))
+    writer = getWriter()
+    writer.SetFileName(os.path.join(out_dir, str(n).rjust(6, '0') + ".dcm"))
     writer.Execute(image_slice)
 
+# Number of slices looked at in one go when scanning the intensities
+slab_size = 16
+
+def getVolumeCount(file_name):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_name)
+    reader.ReadImageInformation()
+    if reader.GetDimension() < 4:
+        return 1
+    return reader.GetSize()[3]
+
+def isSmallInteger(file_name):
+    # Whether the pixels of an image are 8 or 16bit integers
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_name)
+    reader.ReadImageInformation()
+    return reader.GetPixelID() in (sitk.sitkUInt8, sitk.sitkInt8, sitk.sitkUInt16, sitk.sitkInt16)
+
+def readVolumes(file_name, tiff):
+    # Yield the 3d volumes of a 3d or 4d image one by one (reoriented to LPS),
+    # so that never more than one volume is held in memory
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_name)
+    reader.ReadImageInformation()
+    if reader.GetDimension() < 4:
+        volumes = [sitk.ReadImage(file_name)]
+    else:
+        size = list(reader.GetSize())
+        volumes = (extractVolume(reader, size, t) for t in range(size[3]))
+    for img in volumes:
+        if tiff == 0:
+            img = sitk.DICOMOrient(img, "LPS")
+        yield img
+
+def uncompressedCopy(file_name, tmp_dir):
+    # Every volume extracted from a .nii.gz decompresses the file again from the
+    # start, so a 4d .nii.gz is decompressed once, volumes of a .nii are read in place
+    if not file_name.endswith('.gz'):
+        return file_name
+    copy_name = os.path.join(tmp_dir, os.path.basename(file_name)[:-len('.gz')])
+    with gzip.open(file_name, 'rb') as f_in, open(copy_name, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+    return copy_name
+
+def extractVolume(reader, size, t):
+    # A size of 0 along the 4th dimension collapses the output to 3d
+    reader.SetExtractIndex([0, 0, 0, t])
+    reader.SetExtractSize(size[:3] + [0])
+    return reader.Execute()
+
+def getSlabs(img):
+    # Views (not copies) on consecutive slabs of slices
+    data = sitk.GetArrayViewFromImage(img)
+    for z in range(0, data.shape[0], slab_size):
+        yield data[z:z + slab_size]
+
+# Number of bins of the histogram for --window percentile
+nbins = 65536
+
+def addToHistogram(hist, hist_low, hist_width, values):
+    # Add values to a histogram of nbins over [hist_low, hist_low + hist_width].
+    # When values fall outside, the width is doubled (adding the new half below or
+    # above) by summing pairs of bins, so the counts stay exact and the histogram
+    # can be filled in the same pass as the min and max.
+    low, high = float(values.min()), float(values.max())
+    if hist is None:
+        hist = np.zeros(nbins, dtype=np.int64)
+        hist_low = low
+        hist_width = high - low if high > low else max(abs(low), 1.0) * 2.0 ** -20
+    while low < hist_low or high > hist_low + hist_width:
+        merged = hist.reshape(-1, 2).sum(axis=1)
+        hist = np.zeros(nbins, dtype=np.int64)
+        if low < hist_low:
+            hist[nbins // 2:] = merged
+            hist_low -= hist_width
+        else:
+            hist[:nbins // 2] = merged
+        hist_width *= 2
+    hist += np.histogram(values, bins=nbins, range=(hist_low, hist_low + hist_width))[0]
+    return hist, hist_low, hist_width
+
+def getWindow(volumes, mode, percentiles):
+    # Determine the intensity window (low, high) over all volumes, a slab at a time,
+    # in a single pass over the volumes.
+    # For "max" low is None and only the maximum is scaled, as it has always been done.
+    img_max = None
+    low, high = np.inf, -np.inf
+    hist, hist_low, hist_width = None, None, None
+    for img in volumes():
+        for slab in getSlabs(img):
+            if mode == 'max':
+                slab_max = np.amax(slab)
+                img_max = slab_max if img_max is None else np.maximum(img_max, slab_max)
+                continue
+            # minmax and percentile: the finite intensities
+            finite = slab[np.isfinite(slab)]
+            if not finite.size:
+                continue
+            low = min(low, float(finite.min()))
+            high = max(high, float(finite.max()))
+            if mode == 'percentile':
+                hist, hist_low, hist_width = addToHistogram(hist, hist_low, hist_width, finite)
+    if mode == 'max':
+        return (None, img_max)
+
+    if low > high:
+        print('The image contains no finite intensities')
+        exit(1)
+    if mode == 'minmax' or low == high:
+        return (low, high)
+
+    # percentile: from the histogram, within the range of the intensities
+    cdf = np.cumsum(hist) / hist.sum()
+    edges = hist_low + hist_width * np.arange(nbins + 1) / nbins
+    p_low = edges[min(np.searchsorted(cdf, percentiles[0] / 100), nbins - 1)]
+    p_high = edges[min(np.searchsorted(cdf, percentiles[1] / 100), nbins - 1) + 1]
+    return (float(max(p_low, low)), float(min(p_high, high)))
+
+def rescaleSlice(image_slice, window):
+    # Convert a single slice to int16, so the full volume is never copied
+    data = sitk.GetArrayViewFromImage(image_slice)
+    low, high = window
+    if low is None:
+        data_int16 = (data * ( np.iinfo(np.int16).max / high )).astype(np.int16)
+    else:
+        data = np.clip(np.nan_to_num(data, nan=low), low, high) - low
+        scale = np.iinfo(np.int16).max / (high - low) if high > low else 0.0
+        data_int16 = (data * scale).astype(np.int16)
+    int16_slice = sitk.GetImageFromArray(data_int16)
+    int16_slice.CopyInformation(image_slice)
+    return int16_slice
+
+# Enhanced MR Image Storage
+enhanced_mr_sop_class_uid = "1.2.840.10008.5.1.4.1.1.4.1"
+
+# Tags of the series that are replaced by their enhanced (functional group) version
+enhanced_skip_tags = ["0008|0016", "0008|0008", "0020|0037"]
+
+def fillFrame(frames, new_img, i, window=None, first=0):
+    # Put a (rescaled) slice in the frame array of an enhanced object
+    image_slice = new_img[:, :, i]
+    if window is not None:
+        image_slice = rescaleSlice(image_slice, window)
+    frames[first + i] = sitk.GetArrayViewFromImage(image_slice)
+
+def toDS(values):
+    # Decimal strings are limited to 16 characters
+    return [DSfloat(v, auto_format=True) for v in values]
+
+def writeEnhanced(series_tag_values, series_uid, new_img, frames, positions, temporal_index, file_name):
+    # Write all frames as one enhanced MR multi-frame object
+    direction = new_img.GetDirection()
+    spacing = new_img.GetSpacing()
+    sop_instance_uid = series_uid + ".1"
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = enhanced_mr_sop_class_uid
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SpecificCharacterSet = "ISO_IR 100"
+
+    # The donor and series tags are stored once, at the top level: they are patient,
+    # study and series attributes, which cannot go in a functional group
+    for k, v in series_tag_values:
+        if k.startswith("0002") or k.lower() in enhanced_skip_tags:
+            continue
+        tag = pydicom.tag.Tag(int(k[:4], 16), int(k[5:], 16))
+        ds.add_new(tag, dictionary_VR(tag), v)
+
+    ds.SOPClassUID = enhanced_mr_sop_class_uid
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.Modality = "MR"
+    ds.ImageType = ["DERIVED", "SECONDARY", "OTHER", "NONE"]
+    ds.ContentDate = modification_date
+    ds.ContentTime = modification_time
+    ds.InstanceNumber = 1
+    ds.FrameOfReferenceUID = series_uid + ".0"
+    ds.ContentQualification = "RESEARCH"
+    ds.ResonantNucleus = "1H"
+    ds.PixelPresentation = "MONOCHROME"
+    ds.VolumetricProperties = "VOLUME"
+    ds.VolumeBasedCalculationTechnique = "NONE"
+    ds.ComplexImageComponent = "MAGNITUDE"
+    ds.AcquisitionContrast = "UNKNOWN"
+    ds.BurnedInAnnotation = "NO"
+
+    # Dimensions: the position in the stack (and in time)
+    dimension_uid = series_uid + ".2"
+    ds.DimensionOrganizationType = "3D" if temporal_index is None else "3D_TEMPORAL"
+    ds.DimensionOrganizationSequence = [Dataset()]
+    ds.DimensionOrganizationSequence[0].DimensionOrganizationUID = dimension_uid
+    pointers = [0x00209057]  # In-Stack Position Number
+    if temporal_index is not None:
+        pointers.append(0x00209128)  # Temporal Position Index
+    ds.DimensionIndexSequence = []
+    for pointer in pointers:
+        item = Dataset()
+        item.DimensionOrganizationUID = dimension_uid
+        item.DimensionIndexPointer = pointer
+        item.FunctionalGroupPointer = 0x00209111  # Frame Content Sequence
+        ds.DimensionIndexSequence.append(item)
+
+    # Shared functional groups
+    shared = Dataset()
+    shared.PixelMeasuresSequence = [Dataset()]
+    shared.PixelMeasuresSequence[0].PixelSpacing = toDS([spacing[1], spacing[0]])
+    shared.PixelMeasuresSequence[0].SliceThickness = toDS([spacing[2]])[0]
+    shared.PixelMeasuresSequence[0].SpacingBetweenSlices = toDS([spacing[2]])[0]
+    shared.MRImageFrameTypeSequence = [Dataset()]
+    shared.MRImageFrameTypeSequence[0].FrameType = ["DERIVED", "SECONDARY", "OTHER", "NONE"]
+    shared.MRImageFrameTypeSequence[0].PixelPresentation = "MONOCHROME"
+    shared.MRImageFrameTypeSequence[0].VolumetricProperties = "VOLUME"
+    shared.MRImageFrameTypeSequence[0].VolumeBasedCalculationTechnique = "NONE"
+    shared.MRImageFrameTypeSequence[0].ComplexImageComponent = "MAGNITUDE"
+    shared.MRImageFrameTypeSequence[0].AcquisitionContrast = "UNKNOWN"
+    shared.PixelValueTransformationSequence = [Dataset()]
+    shared.PixelValueTransformationSequence[0].RescaleIntercept = "0"
+    shared.PixelValueTransformationSequence[0].RescaleSlope = "1"
+    shared.PixelValueTransformationSequence[0].RescaleType = "US"
+    ds.SharedFunctionalGroupsSequence = [shared]
+
+    # Per-frame functional groups: position, orientation and index of each frame
+    orientation = toDS([direction[0], direction[3], direction[6], direction[1], direction[4], direction[7]])
+    depth = new_img.GetDepth()
+    per_frame = []
+    for n, position in enumerate(positions):
+        frame = Dataset()
+        frame.FrameContentSequence = [Dataset()]
+        frame.FrameContentSequence[0].StackID = "1"
+        frame.FrameContentSequence[0].InStackPositionNumber = n % depth + 1
+        index = [n % depth + 1]
+        if temporal_index is not None:
+            frame.FrameContentSequence[0].TemporalPositionIndex = temporal_index[n]
+            index.append(temporal_index[n])
+        frame.FrameContentSequence[0].DimensionIndexValues = index
+        frame.PlanePositionSequence = [Dataset()]
+        frame.PlanePositionSequence[0].ImagePositionPatient = toDS(position)
+        frame.PlaneOrientationSequence = [Dataset()]
+        frame.PlaneOrientationSequence[0].ImageOrientationPatient = orientation
+        per_frame.append(frame)
+    ds.PerFrameFunctionalGroupsSequence = per_frame
+
+    # Image pixel
+    ds.NumberOfFrames = frames.shape[0]
+    ds.Rows = frames.shape[1]
+    ds.Columns = frames.shape[2]
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = frames.dtype.itemsize * 8
+    ds.BitsStored = frames.dtype.itemsize * 8
+    ds.HighBit = frames.dtype.itemsize * 8 - 1
+    ds.PixelRepresentation = 1 if frames.dtype.kind == 'i' else 0
+    ds.PixelData = frames.tobytes()
+
+    # enforce_file_format came with pydicom 3, before it was write_like_original
+    if int(pydicom.__version__.split('.')[0]) >= 3:
+        pydicom.dcmwrite(file_name, ds, enforce_file_format=True)
+    else:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        pydicom.dcmwrite(file_name, ds, write_like_original=False)
+
+def getSeriesTags(direction, series_uid, series_desc, series_number, extra_tags=()):
+    # Tags that are specific for this series, indicating the change
+    return [
+        ("0008|0031", modification_time),  # Series Time
+        ("0008|0021", modification_date),  # Series Date
+        ("0008|0008", "DERIVED\\SECONDARY"),  # Image Type
+        ("0020|000e", series_uid),  # Series Instance UID
+        (
+            "0020|0037",
+            "\\".join(
+                map(
+                    str,
+                    (
+                        direction[0],
+                        direction[3],
+                        direction[6],
+                        direction[1],
+                        direction[4],
+                        direction[7],
+                    ),
+                )
+            ),
+        ),  # Image Orientation
+        ("0008|103e", series_desc),  # Series Description
+        ("0020|0011", series_number),  # Series Number
+    ] + list(extra_tags)
+
+def newUID():
+    # A UID derived from a random UUID (2.25.<uuid as integer>), so series
+    # converted in the same second, or in parallel, never get the same UID
+    return "2.25." + str(uuid.uuid4().int)
+
+def convertImage(nifti_input, dcm_output, seriesdesc, seriesnumber, workers):
+    # Convert one nifti or tiff against the donor tags in series_tag_values_a
+    img_input, img_ext = os.path.splitext(nifti_input)
+    if img_ext == '.tiff':
+        tiff=1
+        print('Assuming ' + nifti_input + ' is a 3d-tiff')
+    else:
+        tiff=0
+        print('Assuming ' + nifti_input + ' is nifti')
+    # a nifti is rescaled to 16bit, a tiff is written as it is
+    if args.enhanced and tiff == 1 and not isSmallInteger(nifti_input):
+        print('Enhanced dicom can only be written for 8 or 16bit integer data')
+        exit(1)
+    series_instance_uid = newUID()
+
+    # Read the nii or tiff
+    # The volumes are read (and for a nifti rescaled to 16bit) one at a time and
+    # slice by slice, so memory stays at about a single volume.
+    nvol = getVolumeCount(nifti_input)
+    tmp_dir = None
+    if nvol == 1:
+        # a single volume is kept instead of being read again for writing
+        nii_volume = next(readVolumes(nifti_input, tiff))
+        volumes = lambda: iter([nii_volume])
+    else:
+        print('Input has ' + str(nvol) + ' volumes, writing them as ' + args.fourd)
+        # the volumes are read twice (window and writing), from an uncompressed copy
+        # next to the output, so each read only costs the volume itself
+        os.makedirs(os.path.dirname(os.path.abspath(dcm_output)), exist_ok=True)
+        tmp_dir = tempfile.TemporaryDirectory(prefix='KUL_nii2dcm_',
+                                              dir=os.path.dirname(os.path.abspath(dcm_output)))
+        volume_file = uncompressedCopy(nifti_input, tmp_dir.name)
+        volumes = lambda: readVolumes(volume_file, tiff)
+
+    if tiff == 0:
+        # Convert the data to int16
+        print('Converting the nifti to 16bit')
+        window = getWindow(volumes, args.window, args.percentiles)
+        if args.window != 'max':
+            print('Using intensity window ' + str(window[0]) + ' - ' + str(window[1]))
+    else:
+        window = None
+
+    # Clean and Make the output dir
+    if os.path.exists(dcm_output):
+        shutil.rmtree(dcm_output)
+    os.makedirs(dcm_output, exist_ok=True)
+
+    for t, new_img in enumerate(volumes()):
+        out_dir = dcm_output
+        series_uid = series_instance_uid
+        series_desc = seriesdesc
+        first = 0
+        extra_tags = []
+        if nvol > 1 and args.fourd == 'series':
+            # a series per volume, each in its own subdirectory
+            out_dir = os.path.join(dcm_output, 'vol-' + str(t).rjust(4, '0'))
+            os.makedirs(out_dir, exist_ok=True)
+            series_uid = series_instance_uid + "." + str(t + 1)
+            series_desc = seriesdesc + ' vol' + str(t)
+        elif nvol > 1:
+            # one series, numbering the slices on over the volumes
+            first = t * new_img.GetDepth()
+            extra_tags = [
+                ("0020|0100", str(t + 1)),  # Temporal Position Identifier
+                ("0020|0105", str(nvol)),  # Number of Temporal Positions
+            ]
+        series_tag_values = series_tag_values_a + getSeriesTags(
+            new_img.GetDirection(), series_uid, series_desc, seriesnumber, extra_tags)
+
+        # Give info
+        if t == 0:
+            print('Incorporating the following dicom tags:')
+            print(series_tag_values)
+
+        if args.enhanced:
+            # Collect the frames of the series, a single file is written at the end of it
+            depth = new_img.GetDepth()
+            if first == 0:
+                nframes = depth * nvol if nvol > 1 and args.fourd == 'temporal' else depth
+                dtype = np.dtype(np.int16) if window is not None else sitk.GetArrayViewFromImage(new_img).dtype
+                frames = np.empty((nframes, new_img.GetHeight(), new_img.GetWidth()), dtype=dtype)
+                positions = []
+                temporal_index = [] if extra_tags else None
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                list(
+                    pool.map(
+                        lambda i: fillFrame(frames, new_img, i, window, first),
+                        range(depth),
+                    )
+                )
+            positions += [new_img.TransformIndexToPhysicalPoint((0, 0, i)) for i in range(depth)]
+            if temporal_index is not None:
+                temporal_index += [t + 1] * depth
+            if first + depth == nframes:
+                writeEnhanced(series_tag_values, series_uid, new_img, frames, positions, temporal_index,
+                              os.path.join(out_dir, str(0).rjust(6, '0') + ".dcm"))
+            continue
+
+        # Write slices to output directory, spread over the worker threads
+        # (SimpleITK releases the GIL while writing, so the slices are written concurrently)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(
+                pool.map(
+                    lambda i: writeSlices(series_tag_values, series_uid, new_img, out_dir, i, window, first),
+                    range(new_img.GetDepth()),
+                )
+            )
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
 
 
 # set inputs and check
@@ -73,18 +525,6 @@ donor_dcm = args.donor
 if not os.path.exists(donor_dcm):
     print(donor_dcm + ' does not exist')
     exit(1)
-nifti_input = args.nifti
-if not os.path.exists(nifti_input):
-    print(nifti_input + ' does not exist')
-    exit(1)
-img_input, img_ext = os.path.splitext(nifti_input)
-if img_ext == '.tiff':
-    tiff=1
-    print('Assuming input is a 3d-tiff')
-else:
-    tiff=0
-    print('Assuming input is nifti')
-dcm_output = args.dicomdir
 
 # set defaults
 if args.seriesdescription:
@@ -96,6 +536,36 @@ if args.seriesnumber:
 else:
     seriesnumber = ''
 
+# The images to convert: (nifti, dicomdir, seriesdescription, seriesnumber)
+if args.batch:
+    if args.nifti or args.dicomdir:
+        print('Give either a manifest or a nifti and dicomdir')
+        exit(1)
+    if not os.path.exists(args.batch):
+        print(args.batch + ' does not exist')
+        exit(1)
+    conversions = []
+    with open(args.batch, newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            conversions.append((
+                row['nifti'],
+                row['dicomdir'],
+                row.get('seriesdescription') or seriesdesc,
+                row.get('seriesnumber') or seriesnumber,
+            ))
+    dicomdirs = [os.path.abspath(c[1]) for c in conversions]
+    if len(set(dicomdirs)) < len(dicomdirs):
+        print('Each image in ' + args.batch + ' needs its own dicomdir')
+        exit(1)
+else:
+    if not args.nifti or not args.dicomdir:
+        parser.error('the nifti, donor and dicomdir arguments are required')
+    conversions = [(args.nifti, args.dicomdir, seriesdesc, seriesnumber)]
+for nifti_input, dcm_output, series_desc, series_number in conversions:
+    if not os.path.exists(nifti_input):
+        print(nifti_input + ' does not exist')
+        exit(1)
+
 # Read the donor DICOM
 reader = sitk.ImageFileReader()
 reader.SetFileName(donor_dcm)
@@ -134,23 +604,6 @@ tags_to_copy = [
     "0008|0080",  # Institution Name
 ]
 
-# Read the nii or tiff
-nii_img = sitk.ReadImage(nifti_input)
-
-if tiff == 0:
-    # Convert the data to int16
-    print('Converting the nifti to 16bit')
-    np.img_data = sitk.GetArrayFromImage(nii_img)
-    max = np.amax(np.img_data)
-    #print(max)
-    img_int16 = np.img_data * ( np.iinfo(np.int16).max / max )
-    img_int16b = img_int16.astype(np.int16)
-    new_img = sitk.GetImageFromArray(img_int16b)
-    new_img.CopyInformation(nii_img)
-    new_img = sitk.DICOMOrient(new_img, "LPS")
-else:
-    new_img = nii_img
-
 '''
 # Check the data type and set spacing in case of TIFF
 try:
@@ -172,19 +625,13 @@ except:
 #            the files:
 #                  http://www.dclunie.com/dicom3tools.html
 
-writer = sitk.ImageFileWriter()
-# Use the study/series/frame of reference information given in the meta-data
-# dictionary and not the automatically generated information from the file IO
-writer.KeepOriginalImageUIDOn()
-
 modification_time = time.strftime("%H%M%S")
 modification_date = time.strftime("%Y%m%d")
 
 # Copy some of the tags and add the relevant tags indicating the change.
 # For the series instance UID (0020|000e), each of the components is a number,
-# cannot start with zero, and separated by a '.' We create a unique series ID
-# using the date and time. Tags of interest:
-direction = new_img.GetDirection()
+# cannot start with zero, and separated by a '.' Every series gets a UUID
+# based UID (see newUID). Tags of interest:
 series_tag_values_a = [
     (
         k,
@@ -195,55 +642,17 @@ series_tag_values_a = [
     for k in tags_to_copy
     if reader.HasMetaDataKey(k)
 ] 
-series_tag_values_b = [
-    ("0008|0031", modification_time),  # Series Time
-    ("0008|0021", modification_date),  # Series Date
-    ("0008|0008", "DERIVED\\SECONDARY"),  # Image Type
-    (
-        "0020|000e",
-        "1.2.826.0.1.3680043.2.1125."
-        + modification_date
-        + ".1"
-        + modification_time,
-    ),  # Series Instance UID
-    (
-        "0020|0037",
-        "\\".join(
-            map(
-                str,
-                (
-                    direction[0],
-                    direction[3],
-                    direction[6],
-                    direction[1],
-                    direction[4],
-                    direction[7],
-                ),
-            )
-        ),
-    ),  # Image Orientation
-    ("0008|103e", seriesdesc),  # Series Description
-    ("0020|0011", seriesnumber),  # Series Description
-]
-series_tag_values = series_tag_values_a + series_tag_values_b
-
-# Give info
-print('Incorporating the following dicom tags:')
-#print(series_tag_values_a)
-#print(series_tag_values_b)
-print(series_tag_values)
-
-# Clean and Make the output dir
-if os.path.exists(dcm_output):
-    shutil.rmtree(dcm_output)
-os.makedirs(dcm_output, exist_ok=True)
-
-# Write slices to output directory
-list(
-    map(
-        lambda i: writeSlices(series_tag_values, new_img, dcm_output, i),
-        range(new_img.GetDepth()),
-    )
-)
 
-sys.exit(0)
\ No newline at end of file
+# Convert the images; the donor is only read once. In batch mode the images
+# are converted concurrently and the writer threads are divided over them.
+njobs = min(len(conversions), max(1, args.workers))
+workers = max(1, args.workers // njobs)
+with ThreadPoolExecutor(max_workers=njobs) as pool:
+    jobs = [
+        pool.submit(convertImage, nifti_input, dcm_output, series_desc, series_number, workers)
+        for nifti_input, dcm_output, series_desc, series_number in conversions
+    ]
+    for job in jobs:
+        job.result()
+
+sys.exit(0)
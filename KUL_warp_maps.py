@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# Apply ANTs transforms to many maps (e.g. lesion maps to MNI), grouped per transform
+# Used by KUL_anat_lesionheatmap.sh; instead of one antsApplyTransforms per map,
+# all maps of a job (e.g. a subject) that are on the same grid are stacked in a 4D
+# image and warped by one antsApplyTransforms -e 3, so the warp is read once.
+# The jobs run concurrently, the ncpu threads are divided over the running jobs.
+#
+# The manifest is a tab separated file with a header, one line per map, e.g.
+#
+#   job	reference	transforms	interpolation	input	output
+#   sub-P001	mni.nii	w/T1w_warp2_mni1Warp.nii.gz w/T1w_warp2_mni0GenericAffine.mat	NearestNeighbor	P001_lesion.nii.gz	w/P001_lesion_reg2_mni.nii.gz
+#
+# (transforms as given to antsApplyTransforms -t, separated by spaces, e.g. [affine.mat,1])
+# An output is skipped when it exists and the contents of its input, reference and
+# transforms (sha1) and the settings are the same as when it was made. The hashes
+# are kept in <manifest>.state.json.
+
+import os
+import csv
+import json
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+
+
+# a function to read the manifest into jobs (dict of job name -> list of maps)
+def readManifest(manifest):
+    jobs = {}
+    with open(manifest, newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            row = {key.strip(): (value or '').strip() for key, value in row.items()}
+            row['transforms'] = row['transforms'].split()
+            row['interpolation'] = row.get('interpolation') or 'Linear'
+            jobs.setdefault(row['job'], [])
+            # the same output only once
+            if row['output'] not in [m['output'] for m in jobs[row['job']]]:
+                jobs[row['job']].append(row)
+    return jobs
+
+# a function to get the file of a transform argument, e.g. [affine.mat,1] -> affine.mat
+def getTransformFile(transform):
+    return transform.strip('[]').split(',')[0]
+
+# a function to get the sha1 of the contents of a file, cached by size & mtime
+file_hashes = {}
+hash_lock = threading.Lock()
+def getFileHash(file_name):
+    st = os.stat(file_name)
+    key = os.path.abspath(file_name)
+    with hash_lock:
+        cached = file_hashes.get(key)
+    if cached is not None and cached[:2] == [st.st_size, st.st_mtime_ns]:
+        return cached[2]
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    with hash_lock:
+        file_hashes[key] = [st.st_size, st.st_mtime_ns, sha1.hexdigest()]
+    return sha1.hexdigest()
+
+# a function to get the hash of everything an output depends on
+def getOutputHash(lesion_map):
+    inputs = [getFileHash(lesion_map['input']), getFileHash(lesion_map['reference'])] + \
+        [getFileHash(getTransformFile(t)) for t in lesion_map['transforms']]
+    settings = [lesion_map['transforms'], lesion_map['interpolation']]
+    return hashlib.sha1(json.dumps([inputs, settings]).encode()).hexdigest()
+
+# a function to run antsApplyTransforms with nthreads
+def applyTransforms(input, output, lesion_map, nthreads, timeseries=False):
+    cmd = ['antsApplyTransforms', '-d', '3', '--float', '1', '-i', input, '-o', output,
+           '-r', lesion_map['reference'], '-n', lesion_map['interpolation']]
+    if timeseries:
+        cmd += ['-e', '3']
+    for transform in lesion_map['transforms']:
+        cmd += ['-t', transform]
+    env = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(nthreads))
+    result = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(' '.join(cmd) + '\n' + result.stdout)
+
+# a function to write a volume of the warped stack as output, with the data type of its input
+def saveVolume(data, warped_img, input_img, output):
+    dtype = input_img.get_data_dtype()
+    if np.issubdtype(dtype, np.integer):
+        data = np.rint(data)
+    header = warped_img.header.copy()
+    header.set_data_dtype(dtype)
+    nib.save(nib.Nifti1Image(data.astype(dtype), warped_img.affine, header), output)
+
+# a function to warp maps that share the transforms (and the grid of the inputs) at once
+def warpStack(stack, nthreads):
+    for lesion_map in stack:
+        os.makedirs(os.path.dirname(os.path.abspath(lesion_map['output'])), exist_ok=True)
+    if len(stack) == 1:
+        applyTransforms(stack[0]['input'], stack[0]['output'], stack[0], nthreads)
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        imgs = [nib.load(lesion_map['input']) for lesion_map in stack]
+        data = np.stack([np.asarray(img.dataobj, dtype=np.float32) for img in imgs], axis=-1)
+        # the header of the first map, so the stack keeps its qform/sform codes and voxel sizes
+        header = imgs[0].header.copy()
+        header.set_data_dtype(np.float32)
+        header.set_slope_inter(1, 0)
+        nib.save(nib.Nifti1Image(data, imgs[0].affine, header), os.path.join(tmp_dir, 'stack.nii.gz'))
+        del data
+        applyTransforms(os.path.join(tmp_dir, 'stack.nii.gz'), os.path.join(tmp_dir, 'warped.nii.gz'),
+                        stack[0], nthreads, timeseries=True)
+        warped_img = nib.load(os.path.join(tmp_dir, 'warped.nii.gz'))
+        warped = np.asarray(warped_img.dataobj)
+        for i, lesion_map in enumerate(stack):
+            saveVolume(warped[..., i], warped_img, imgs[i], lesion_map['output'])
+
+# a function to run a job: the maps that are not up to date, stacked per transforms, reference & grid
+# returns (job, number of maps warped, number up to date, hashes of the warped outputs)
+def runJob(job, lesion_maps, state, nthreads):
+    todo = []
+    hashes = {}
+    for lesion_map in lesion_maps:
+        output_hash = getOutputHash(lesion_map)
+        if os.path.exists(lesion_map['output']) and state.get(os.path.abspath(lesion_map['output'])) == output_hash:
+            continue
+        hashes[os.path.abspath(lesion_map['output'])] = output_hash
+        todo.append(lesion_map)
+    stacks = {}
+    for lesion_map in todo:
+        header = nib.load(lesion_map['input']).header
+        key = json.dumps([lesion_map['reference'], lesion_map['transforms'], lesion_map['interpolation'],
+                          [int(d) for d in header.get_data_shape()[:3]], np.round(header.get_best_affine(), 4).tolist()])
+        stacks.setdefault(key, []).append(lesion_map)
+    for key in stacks:
+        warpStack(stacks[key], nthreads)
+    return job, len(todo), len(lesion_maps) - len(todo), hashes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Apply ANTs transforms to many maps, grouped per transform",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('manifest', help='tab separated manifest (job, reference, transforms, interpolation, input, output)')
+    parser.add_argument('-n', '--ncpu', type=int, default=os.cpu_count(), help='number of threads in total')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.manifest):
+        print(args.manifest + ' does not exist')
+        exit(1)
+    jobs = readManifest(args.manifest)
+    for job in jobs:
+        for lesion_map in jobs[job]:
+            for file_name in [lesion_map['input'], lesion_map['reference']] + \
+                    [getTransformFile(t) for t in lesion_map['transforms']]:
+                if not os.path.exists(file_name):
+                    print(file_name + ' does not exist')
+                    exit(1)
+
+    state_file = args.manifest + '.state.json'
+    state = {'outputs': {}, 'files': {}}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+    file_hashes.update(state['files'])
+
+    # the threads of antsApplyTransforms are divided over the running jobs
+    njobs = max(1, min(args.ncpu, len(jobs)))
+    nthreads = max(1, args.ncpu // njobs)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        futures = [pool.submit(runJob, job, jobs[job], state['outputs'], nthreads) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                job, nwarped, nskipped, hashes = future.result()
+            except Exception as e:
+                failed += 1
+                print(job + ': FAILED ' + str(e))
+                continue
+            print(job + ': ' + str(nwarped) + ' maps warped, ' + str(nskipped) + ' up to date')
+            state['outputs'].update(hashes)
+            with hash_lock:
+                state['files'] = dict(file_hashes)
+            with open(state_file + '.tmp', 'w') as f:
+                json.dump(state, f, indent=1)
+            os.replace(state_file + '.tmp', state_file)
+
+    print(str(len(jobs) - failed) + ' of ' + str(len(jobs)) + ' jobs ok')
+    exit(1 if failed else 0)
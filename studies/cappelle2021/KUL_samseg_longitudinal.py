@@ -1,15 +1,20 @@
 #!/usr/bin/env python
 
 import argparse
-import glob 
+import glob
 import os
+import time
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 
 parser = argparse.ArgumentParser(description="Run the longitudinal version of samseg",
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
 parser.add_argument("-F", "--flair", action="store_true", help="use the flair as well")
-parser.add_argument("-n", "--ncpu", help="number of threads to use for samseg")
+parser.add_argument("-n", "--ncpu", help="number of cores to use in total (all steps and subjects together)")
+parser.add_argument("-s", "--samseg_threads", help="number of threads per samseg (default ncpu divided over the subjects, at least 4)")
 parser.add_argument("dest", help="Destination location")
 args = parser.parse_args()
 config = vars(args)
@@ -18,107 +23,163 @@ config = vars(args)
 if args.ncpu is None:
     ncpu = 15
 else:
-    ncpu = args.ncpu
+    ncpu = int(args.ncpu)
 
 bidsdir = './BIDS'
 outdir = args.dest
 #print(outdir)
 
+# The steps of all subjects share a budget of ncpu cores: a step waits until its
+# cores are free. The single-threaded steps (mrgrid, mri_robust_template, mri_vol2vol)
+# use 1 core, mri_coreg and samseg the number of threads they are given.
+free_cores = ncpu
+cores_changed = threading.Condition()
+print_lock = threading.Lock()
+step_times = []
 
+def runStep(subject, step, cmd, cores=1):
+    # run a command when cores are free, with its thread count limited to cores
+    global free_cores
+    cores = max(1, min(cores, ncpu))
+    with cores_changed:
+        cores_changed.wait_for(lambda: free_cores >= cores)
+        free_cores -= cores
+    env = dict(os.environ, OMP_NUM_THREADS=str(cores), MRTRIX_NTHREADS=str(cores),
+               ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(cores))
+    start = time.time()
+    try:
+        out = subprocess.run(cmd, shell=True, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True).stdout.strip()
+    finally:
+        with cores_changed:
+            free_cores += cores
+            cores_changed.notify_all()
+    seconds = time.time() - start
+    with print_lock:
+        step_times.append((subject, step, cores, seconds))
+        print(cmd)
+        print(out)
+        print(subject + ': ' + step + ' took ' + str(round(seconds, 1)) + ' s on ' + str(cores) + ' cores')
+
+def regrid(subject, input, output):
+    # regrid the input to 1mm isotropic
+    if not os.path.exists(output):
+        runStep(subject, 'mrgrid ' + os.path.basename(output),
+                'mrgrid ' + input + ' regrid -voxel 1 ' + output)
+
+def coregFlair(subject, Im, lta, T1w_reg, flair_reg, threads):
+    if not os.path.exists(lta):
+        runStep(subject, 'mri_coreg ' + os.path.basename(Im),
+                'mri_coreg --threads ' + str(threads) + ' --mov ' + Im  + ' --ref ' + T1w_reg + ' --reg ' + lta, threads)
+        runStep(subject, 'mri_vol2vol ' + os.path.basename(Im),
+                'mri_vol2vol --mov ' + Im + ' --reg ' + lta + ' --o ' + flair_reg + ' --targ ' + T1w_reg)
+
+def processSubject(root, dir, threads):
+    searchdir = os.path.join(root, dir)
+    #print(searchdir)
+    #print(dir)
+    os.makedirs(os.path.join(outdir,dir), exist_ok=True)
+
+    for ImType in ["T1w"]:
+
+        searchIms = searchdir + '/*/anat/*' + ImType + '.nii.gz'
+        #print(searchIms)
+
+        # find all Im
+        Ims = glob.glob(searchIms)
+        #print(Ims)
+
+        regrids = []
+        Imsreg_input = []
+        flairreg_input = []
+        Imsreg_output = []
+        flairreg_output = []
+        for Im in Ims:
+            dir_name, base_name = os.path.split(os.path.splitext(os.path.splitext(Im)[0])[0])
+            #print(dir_name)
+            base_name = base_name.split('_T1w')[0]
+            #print(base_name)
+            flair_search = os.path.join(dir_name, base_name + '_FLAIR.nii.gz')
+            T1w_iso_output = os.path.join(outdir, dir, base_name + '_T1w_iso.nii.gz')
+            #print(T1w_iso_output)
+            regrids.append((Im, T1w_iso_output))
+            #print(flair_search)
+            if args.flair:
+                if os.path.exists(flair_search):
+                    #print('There is a flair')
+                    flair_iso_output = os.path.join(outdir, dir, base_name + '_FLAIR_iso.nii.gz')
+                    #print(flair_iso_output)
+                    regrids.append((flair_search, flair_iso_output))
+                    Imsreg_input.append(T1w_iso_output)
+                    flairreg_input.append(flair_iso_output)
+                    Imsreg_output.append(os.path.join(outdir, dir, base_name + '_T1w_iso_reg.mgz'))
+                    flairreg_output.append(os.path.join(outdir, dir, base_name + '_FLAIR_iso_reg.mgz'))
+            else:
+                Imsreg_input.append(T1w_iso_output)
+                Imsreg_output.append(os.path.join(outdir, dir, base_name + '_T1w_iso_reg.mgz'))
+        #print(Imsreg_input)
+        #print(Imsreg_output)
+
+        # the regrids are independent of each other
+        with ThreadPoolExecutor(max_workers=max(1, len(regrids))) as pool:
+            list(pool.map(lambda r: regrid(dir, r[0], r[1]), regrids))
+
+        mean_template = os.path.join(outdir, dir, 'T1w_mean.mgz')
+        if not os.path.exists(mean_template):
+            cmd = 'mri_robust_template --mov ' + ' '.join(Imsreg_input) + ' --template ' + mean_template \
+                + ' --satit --mapmov ' + ' '.join(Imsreg_output)
+            runStep(dir, 'mri_robust_template', cmd)
+
+        if args.flair:
+            # the co-registrations of the flairs are independent of each other
+            coregs = []
+            for i, Im in enumerate(flairreg_input):
+                dir_name, base_name = os.path.split(os.path.splitext(os.path.splitext(Im)[0])[0])
+                lta = os.path.join(outdir, dir, base_name + '_FLAIRtoT1.lta')
+                coregs.append((Im, lta, Imsreg_output[i], flairreg_output[i]))
+            coreg_threads = max(1, threads // max(1, len(coregs)))
+            with ThreadPoolExecutor(max_workers=max(1, len(coregs))) as pool:
+                list(pool.map(lambda c: coregFlair(dir, c[0], c[1], c[2], c[3], coreg_threads), coregs))
+
+        cmd_input = []
+        i=0
+        for samseg_input in Imsreg_output:
+            if args.flair:
+                cmd_input.append('--timepoint ' + flairreg_output[i] + ' ' + Imsreg_output[i])
+            else:
+                cmd_input.append('--timepoint ' + samseg_input)
+            i = i + 1
+        cmd = 'run_samseg_long ' + ' '.join(cmd_input) + ' --output ' + os.path.join(outdir, dir, 'samseg') + \
+            ' --lesion --lesion-mask-pattern 1 0 --threshold 0.7 ' + ' --threads ' + str(threads)
+        if not os.path.exists(os.path.join(outdir, dir, 'samseg')):
+            runStep(dir, 'run_samseg_long', cmd, threads)
+
+
+subjects = []
 for root, dirs, files in os.walk(bidsdir):
     for dir in dirs:
         if 'sub-' in dir:
-            searchdir = os.path.join(root, dir)
-            #print(searchdir)
-            #print(dir)
-            os.makedirs(os.path.join(outdir,dir), exist_ok=True)
-
-            for ImType in ["T1w"]:
-
-                searchIms = searchdir + '/*/anat/*' + ImType + '.nii.gz'
-                #print(searchIms)
-                
-                # find all Im
-                Ims = glob.glob(searchIms)
-                #print(Ims)
-
-                Imsreg_input = [] 
-                flairreg_input = []
-                Imsreg_output = [] 
-                flairreg_output = [] 
-                for Im in Ims:
-                    # regrid the input to 1mm isotropic
-                    
-                    dir_name, base_name = os.path.split(os.path.splitext(os.path.splitext(Im)[0])[0])
-                    #print(dir_name)
-                    base_name = base_name.split('_T1w')[0]
-                    #print(base_name)
-                    flair_search = os.path.join(dir_name, base_name + '_FLAIR.nii.gz')
-                    T1w_iso_output = os.path.join(outdir, dir, base_name + '_T1w_iso.nii.gz')
-                    #print(T1w_iso_output)
-                    cmd = 'mrgrid ' + Im + ' regrid -voxel 1 ' + T1w_iso_output
-                    print(cmd)
-                    if not os.path.exists(T1w_iso_output):
-                        out = os.popen(cmd).read().strip()
-                        print(out)
-                    #print(flair_search)
-                    if args.flair: 
-                        if os.path.exists(flair_search):
-                            #print('There is a flair')
-                            flair_iso_output = os.path.join(outdir, dir, base_name + '_FLAIR_iso.nii.gz')
-                            #print(flair_iso_output)
-                            cmd = 'mrgrid ' + flair_search + ' regrid -voxel 1 ' + flair_iso_output
-                            #print(cmd)
-                            if not os.path.exists(flair_iso_output):
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-                            Imsreg_input.append(T1w_iso_output)
-                            flairreg_input.append(flair_iso_output)
-                            Imsreg_output.append(os.path.join(outdir, dir, base_name + '_T1w_iso_reg.mgz'))
-                            flairreg_output.append(os.path.join(outdir, dir, base_name + '_FLAIR_iso_reg.mgz'))
-                    else:
-                        Imsreg_input.append(T1w_iso_output)
-                        Imsreg_output.append(os.path.join(outdir, dir, base_name + '_T1w_iso_reg.mgz'))
-                #print(Imsreg_input)
-                #print(Imsreg_output)
-                
-                mean_template = os.path.join(outdir, dir, 'T1w_mean.mgz')
-                if not os.path.exists(mean_template):
-                    cmd = 'mri_robust_template --mov ' + ' '.join(Imsreg_input) + ' --template ' + mean_template \
-                        + ' --satit --mapmov ' + ' '.join(Imsreg_output)
-                    print(cmd)
-
-                    out = os.popen(cmd).read().strip()
-                    print(out)
-
-                if args.flair:
-                    i=0
-                    for Im in flairreg_input:
-                        dir_name, base_name = os.path.split(os.path.splitext(os.path.splitext(Im)[0])[0])
-                        lta = os.path.join(outdir, dir, base_name + '_FLAIRtoT1.lta')
-                        if not os.path.exists(lta):
-                            cmd = 'mri_coreg --threads ' + str(ncpu) + ' --mov ' + Im  + ' --ref ' + Imsreg_output[i] + ' --reg ' + lta
-                            print(cmd)
-                            out = os.popen(cmd).read().strip()
-                            print(out)
-                            cmd = 'mri_vol2vol --mov ' + Im + ' --reg ' + lta + ' --o ' + flairreg_output[i] + ' --targ ' + Imsreg_output[i]
-                            print(cmd)
-                            out = os.popen(cmd).read().strip()
-                            print(out)
-                        i = i + 1
-                
-                cmd_input = []
-                i=0
-                for samseg_input in Imsreg_output:
-                    if args.flair:
-                        cmd_input.append('--timepoint ' + flairreg_output[i] + ' ' + Imsreg_output[i])
-                    else: 
-                        cmd_input.append('--timepoint ' + samseg_input)
-                    i = i + 1
-                cmd = 'run_samseg_long ' + ' '.join(cmd_input) + ' --output ' + os.path.join(outdir, dir, 'samseg') + \
-                    ' --lesion --lesion-mask-pattern 1 0 --threshold 0.7 ' + ' --threads ' + str(ncpu)
-                if not os.path.exists(os.path.join(outdir, dir, 'samseg')):
-                    print(cmd)
-                    out = os.popen(cmd).read().strip()
-                    print(out)
-                
+            subjects.append((root, dir))
+subjects.sort()
+
+# the cores are divided over the samseg runs of the subjects
+if args.samseg_threads is None:
+    threads = min(ncpu, max(4, ncpu // max(1, len(subjects))))
+else:
+    threads = min(ncpu, int(args.samseg_threads))
+print('Processing ' + str(len(subjects)) + ' subjects on ' + str(ncpu) + ' cores, samseg with ' + str(threads) + ' threads')
+
+start = time.time()
+with ThreadPoolExecutor(max_workers=max(1, min(len(subjects), ncpu))) as pool:
+    list(pool.map(lambda s: processSubject(s[0], s[1], threads), subjects))
+
+# the wall time of every step, to tune the split of the cores
+os.makedirs(outdir, exist_ok=True)
+times_tsv = os.path.join(outdir, 'KUL_samseg_longitudinal_times.tsv')
+with open(times_tsv + '.tmp', 'w') as f:
+    f.write('subject\tstep\tcores\tseconds\n')
+    for subject, step, cores, seconds in sorted(step_times):
+        f.write(subject + '\t' + step + '\t' + str(cores) + '\t' + str(round(seconds, 1)) + '\n')
+    f.write('all\ttotal\t' + str(ncpu) + '\t' + str(round(time.time() - start, 1)) + '\n')
+os.replace(times_tsv + '.tmp', times_tsv)
+print('Step times written to ' + times_tsv)
@@ -8,6 +8,10 @@ import os
 bidsdir = './T1T2FLAIRMTR_ratio'
 outdir = './samseg_long'
 """
+# warp the lesions of all sessions to MNI, the lesions sharing a transform at once (see KUL_warp_maps.py)
+warp_manifest = 'warp_lesions2mni.tsv'
+manifest = open(warp_manifest, 'w')
+manifest.write('job\treference\ttransforms\tinterpolation\tinput\toutput\n')
 for root, dirs, files in os.walk(bidsdir):
 
     #print(dirs)
@@ -58,20 +62,12 @@ for root, dirs, files in os.walk(bidsdir):
                     #    -r $reference \
                     #    -t $transform1 -t $transform2 \
                     #    -n $interpolation_type
-                    cmd = 'antsApplyTransforms -d 3  -i ' + input + \
-                        ' -o ' + output + \
-                        ' -r ' + Im + \
-                        ' -t ' + transform1 + ' ' + transform2 + \
-                        ' -n NearestNeighbor'
-
-                    #print(cmd)
-                    
-                    if not os.path.exists(output):
-                        print('Warping image ' + input)
-                        out = os.popen(cmd).read().strip()
-                        print(out)
-                    else:
-                        print('Already warped ' + input)
+                    manifest.write(base_name + '\t' + Im + '\t' + transform1 + ' ' + transform2 + \
+                        '\tNearestNeighbor\t' + input + '\t' + output + '\n')
+manifest.close()
+cmd = 'KUL_warp_maps.py ' + warp_manifest
+out = os.popen(cmd).read().strip()
+print(out)
 """
 # Compute the sum of lesions of the first timepoint of all subjects
 old_root=[]
@@ -89,7 +85,12 @@ for root, dirs, files in os.walk(bidsdir):
             old_root=root
 #print(' '.join(list))
 print(len(list))
-cmd = 'mrmath ' + ' '.join(list) + ' sum ' + 'tp_first_MSLesion.nii.gz -force'
+lesion_list = 'tp_first_MSLesion.txt'
+with open(lesion_list, 'w') as f:
+    for im in list:
+        for lesion in sorted(glob.glob(im)):
+            f.write(lesion + '\n')
+cmd = 'KUL_lesion_accumulator.py -l ' + lesion_list + ' -o tp_first_MSLesion.nii.gz'
 out = os.popen(cmd).read().strip()
 print(out)
 
@@ -109,6 +110,11 @@ for root, dirs, files in os.walk(bidsdir):
             old_root=root
 #print(' '.join(list))
 print(len(list))
-cmd = 'mrmath ' + ' '.join(list) + ' sum ' + 'tp_last_MSLesion.nii.gz -force'
+lesion_list = 'tp_last_MSLesion.txt'
+with open(lesion_list, 'w') as f:
+    for im in list:
+        for lesion in sorted(glob.glob(im)):
+            f.write(lesion + '\n')
+cmd = 'KUL_lesion_accumulator.py -l ' + lesion_list + ' -o tp_last_MSLesion.nii.gz'
 out = os.popen(cmd).read().strip()
 print(out)             
@@ -3,316 +3,487 @@
 import argparse
 import glob 
 import os
+import json
+import shutil
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import nibabel as nib
 from scipy import ndimage
 
-parser = argparse.ArgumentParser(description="Determine the postion of the DRT on AC-PC",
-                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
-parser.add_argument("-n", "--ncpu", help="number of threads to use for samseg")
-parser.add_argument("-i", "--info", help="info file with slice positions")
-parser.add_argument("dest", help="Destination location")
-args = parser.parse_args()
-config = vars(args)
-#print(config)
-
-if args.ncpu is None:
-    ncpu = 15
-else:
-    ncpu = args.ncpu
+# Define functions
+# The images are handled in memory with nibabel/numpy/scipy, only the final outputs are written.
+# The regrid of the DRT map to the T1w grid is left to mrgrid.
+
+def saveImage(data, ref_img, file_name):
+    # write data (as float32, like mrcalc/mredit did) on the grid of ref_img
+    header = ref_img.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.save(nib.Nifti1Image(data.astype(np.float32), ref_img.affine, header), file_name)
+
+def acpcSlab(data, lower=95, upper=144):
+    # keep the slices between lower and upper (from the end) along axis 2, as
+    # mrgrid crop -axis 2 lower,upper | mrgrid pad -axis 2 lower,upper
+    slab = np.zeros_like(data)
+    slab[:, :, lower:data.shape[2] - upper] = data[:, :, lower:data.shape[2] - upper]
+    return slab
+
+def planeImage(shape, z, value=100):
+    # an empty image with one plane along axis 2 set to value (mredit -plane 2 z value)
+    data = np.zeros(shape, dtype=np.float32)
+    data[:, :, z] = value
+    return data
+
+def voxelImage(shape, xyz, value=1):
+    # an empty image with one voxel set to value (mredit -voxel x,y,z value)
+    data = np.zeros(shape, dtype=np.float32)
+    data[xyz[0], xyz[1], xyz[2]] = value
+    return data
+
+def outlineImage(data):
+    # maskfilter dilate | mrcalc - data -sub
+    dilated = ndimage.binary_dilation(data != 0, structure=ndimage.generate_binary_structure(3, 1))
+    return dilated.astype(np.float32) - data
+
+def markerImage(shape, position, value):
+    data = np.zeros(shape)
+    data[round(position[0]), round(position[1]), round(position[2])] = value
+    return data
+
+# The streamlines are read from the .tck directly (memory-mapped), see
+# https://mrtrix.readthedocs.io/en/latest/getting_started/image_data.html#tracks-file-format-tck
+
+tck_datatypes = {'Float32LE': '<f4', 'Float32BE': '>f4', 'Float64LE': '<f8', 'Float64BE': '>f8'}
+
+def readTckHeader(tck_file):
+    # the key: value lines of the header, up to END
+    header = {}
+    with open(tck_file, 'rb') as f:
+        if f.readline().strip() != b'mrtrix tracks':
+            raise ValueError(tck_file + ' is not a tck file')
+        for line in f:
+            line = line.decode('latin-1').strip()
+            if line == 'END':
+                break
+            key, sep, value = line.partition(':')
+            header[key.strip()] = value.strip()
+    return header
+
+def readTckVertices(tck_file, header):
+    # all vertices (n x 3, scanner coordinates in mm) as a memory map; the streamlines
+    # are separated by a NaN vertex and the file ends with an Inf vertex
+    offset = int(header['file'].split()[1])
+    data = np.memmap(tck_file, dtype=tck_datatypes[header['datatype']], mode='r', offset=offset)
+    return data[:len(data) // 3 * 3].reshape(-1, 3)
+
+def getTckCount(tck_file):
+    # the number of streamlines (count of the header, like tckstats -output count)
+    header = readTckHeader(tck_file)
+    if 'count' in header:
+        return str(int(header['count']))
+    return str(np.count_nonzero(np.isnan(readTckVertices(tck_file, header)[:, 0])))
+
+def fitPlane(mask):
+    # the plane (normal, offset: normal . p = offset) through the voxels of mask
+    coords = np.argwhere(mask).astype(np.float64)
+    centre = coords.mean(axis=0)
+    normal = np.linalg.svd(coords - centre, full_matrices=False)[2][-1]
+    return normal, normal @ centre
+
+def planeCrossings(vertices, affine, planes, chunk=1000000):
+    # the points (voxel coordinates of affine) where the streamline segments cross each of the planes;
+    # the vertices are read in chunks (overlapping by one vertex), so the tck is never fully in memory
+    inverse = np.linalg.inv(affine)
+    points = [[] for plane in planes]
+    for start in range(0, max(len(vertices) - 1, 0), chunk):
+        with np.errstate(invalid='ignore'):
+            v = np.asarray(vertices[start:start + chunk + 1], dtype=np.float64) @ inverse[:3, :3].T + inverse[:3, 3]
+        p0 = v[:-1]
+        p1 = v[1:]
+        # segments to or from a separator (NaN) or the end (Inf) are not part of a streamline
+        valid = np.all(np.isfinite(p0), axis=1) & np.all(np.isfinite(p1), axis=1)
+        for plane_points, (normal, offset) in zip(points, planes):
+            s0 = p0 @ normal - offset
+            s1 = p1 @ normal - offset
+            cross = valid & ((s0 < 0) != (s1 < 0))
+            t = (s0[cross] / (s0[cross] - s1[cross]))[:, np.newaxis]
+            plane_points.append(p0[cross] + t * (p1[cross] - p0[cross]))
+    return [np.concatenate(p) if p else np.zeros((0, 3)) for p in points]
+
+def centroid(points):
+    if len(points) == 0:
+        return (np.nan, np.nan, np.nan)
+    return tuple(points.mean(axis=0))
+
+def densityPeak(points, bandwidth=1.0, bin_size=0.5, iterations=20):
+    # the position of highest density of the points (gaussian kernel of bandwidth voxels):
+    # the highest bin of a grid of bin_size voxels, refined by mean shift
+    if len(points) == 0:
+        return (np.nan, np.nan, np.nan)
+    margin = int(np.ceil(3 * bandwidth / bin_size))
+    lower = points.min(axis=0) - margin * bin_size
+    bins = np.floor((points - lower) / bin_size).astype(int)
+    hist = np.zeros(bins.max(axis=0) + margin + 1)
+    np.add.at(hist, tuple(bins.T), 1)
+    density = ndimage.gaussian_filter(hist, bandwidth / bin_size)
+    peak = lower + (np.array(np.unravel_index(np.argmax(density), density.shape)) + 0.5) * bin_size
+    for iteration in range(iterations):
+        weights = np.exp(-np.sum((points - peak) ** 2, axis=1) / (2 * bandwidth ** 2))
+        peak = weights @ points / np.sum(weights)
+    return tuple(peak)
 
 bidsdir = './fmriprep'
-outdir = args.dest
-#print(outdir)
-
-results_csv = os.path.join(outdir) + 'Results_DRT.csv'
-cmd = 'echo "base_name, type, ses, side, count, CMx, CMy, CMz" > ' + results_csv
-print(cmd)
-out = os.popen(cmd).read().strip()
-print(out)
-
-results_csv_new = os.path.join(outdir) + 'Results_DRT_new.csv'
-cmd = 'echo "base_name, type, ses, side, count, CMx, CMy, CMz" > ' + results_csv_new
-print(cmd)
-out = os.popen(cmd).read().strip()
-print(out)
-
-info_ods = args.info
-ods = pd.read_excel(info_ods, engine='odf')
-
-print(ods)
-#print(ods.left_z)
-#print(round(ods.left_z[0]))
-basename='sub-HC10'
-j = ods[ods['subjectid']==basename]
-#print(j)
-print(j.left_z.array)
-print(str(round(j.left_z.array[0])))
-#p=j.left_y
-#print(p.array)
-#print(type(p))
-#print(p.array[0])
-#exit()
-
-for root, dirs, files in os.walk(bidsdir):
-    for dir in dirs:
-        if 'sub-' in dir:
-            searchdir = os.path.join(root, dir)
-            #print(searchdir)
-            #print(dir)
-            os.makedirs(os.path.join(outdir,dir), exist_ok=True)
-
-            for ImType in ["space-MNI152NLin2009cAsym_desc-preproc_T1w"]:
-
-                searchIms = searchdir + '/anat/*' + ImType + '.nii.gz'
-                print(searchIms)
-                
-
-                # find all Im
-                Ims = glob.glob(searchIms)
-                print(str(Ims))
-
-                for Im in Ims: 
-                    # empty the MNI image, except slice 95 (AC/PC)
-                    dir_name, base_name = os.path.split(os.path.splitext(os.path.splitext(Im)[0])[0])
-                    output = os.path.join(outdir, dir, base_name) + '_acpc_plane.nii.gz'
-                    print(output)
-                    cmd = 'mrgrid ' + Im + ' crop -axis 2 95,144 - | mrgrid - pad -axis 2 95,144 -force ' + output
-                    print(cmd)
-                    out = os.popen(cmd).read().strip()
-                    print(out)
-                    
-                    cmd = 'cp ' + Im + ' ' + os.path.join(outdir,dir)
-                    out = os.popen(cmd).read().strip()
-                    print(out)
-
-                    # warp that back to subject space
-                    input = output
-                    base_name = base_name.split('_space')[0]
-                    print(base_name)
-                    plane = os.path.join(outdir, dir, base_name) + '_T1w_acpc_plane.nii.gz'
-                    transform = os.path.join(dir_name, base_name) + '_from-MNI152NLin2009cAsym_to-T1w_mode-image_xfm.h5'
-                    reference = os.path.join(dir_name, base_name) + '_desc-preproc_T1w.nii.gz'
-                    cmd = 'antsApplyTransforms -d 3 --float 1 --verbose 1' + \
-                        ' -i ' + input + \
-                        ' -o ' + plane + \
-                        ' -r ' + reference + \
-                        ' -t ' + transform + \
-                        ' -n Linear'
-                    print(cmd)
-                    out = os.popen(cmd).read().strip()
-                    print(out)
-                    cmd = 'cp ' + reference + ' ' + os.path.join(outdir,dir)
-                    out = os.popen(cmd).read().strip()
-                    print(out)
-
-                    if 0 : 
-                        # intersect the DRT with the plane in subject space
-                        drt = os.path.join('.','BIDS','derivatives','KUL_compute',base_name,'ses-T0','FWT', base_name + '_TCKs_output','DRT_LT_output', 'DRT_LT_fin_BT_iFOD2.tck')
-                        print(drt)
-                        cmd = 'cp ' + drt + ' ' + os.path.join(outdir,dir)
-                        print(cmd)
-                        out = os.popen(cmd).read().strip()
-                        print(out)
-
-                        # smooth the tract
-                        drt_smooth = os.path.join(outdir, dir, base_name) + '_DRT_LT_smooth.tck'
-                        cmd = 'scil_smooth_streamlines.py -f --gaussian 25 --reference ' + plane + ' ' + drt + ' ' + drt_smooth
-                        out = os.popen(cmd).read().strip()
-                        print(out)
-                        out = os.popen(cmd).read().strip()
-                        print(out)
+results_header = "base_name, type, ses, side, count, CMx, CMy, CMz"
+
+# The arguments, output directory and info file, set by main() and, through the
+# initializer of the pool, in each worker process (which does not run main())
+args = None
+outdir = None
+ods = None
+
+def setGlobals(main_args, main_ods):
+    global args, outdir, ods
+    args = main_args
+    outdir = main_args.dest
+    ods = main_ods
+
+def getSubjectInputs(searchdir):
+    # the files a subject depends on (with size and mtime) and its rows of the info file
+    inputs = []
+    for Im in sorted(glob.glob(searchdir + '/anat/*space-MNI152NLin2009cAsym_desc-preproc_T1w.nii.gz')):
+        dir_name, base_name = os.path.split(os.path.splitext(os.path.splitext(Im)[0])[0])
+        base_name = base_name.split('_space')[0]
+        files = [Im, os.path.join(dir_name, base_name) + '_from-MNI152NLin2009cAsym_to-T1w_mode-image_xfm.h5',
+                 os.path.join(dir_name, base_name) + '_desc-preproc_T1w.nii.gz']
+        files += sorted(glob.glob(os.path.join('.','BIDS','derivatives','KUL_compute',base_name,'ses-*','FWT', \
+            base_name + '_TCKs_output','DRT_*_output', 'DRT_*_fin_*')))
+        for f in files:
+            st = os.stat(f) if os.path.exists(f) else None
+            inputs.append([f, st.st_size if st else None, st.st_mtime_ns if st else None])
+        inputs.append(ods[ods['subjectid']==base_name].to_json())
+    return inputs
+
+def processSubject(root, dir):
+    # process one subject and return its records (csv, base_name, type, ses, side, count, x, y, z)
+    records = []
+    searchdir = os.path.join(root, dir)
+    #print(searchdir)
+    #print(dir)
+    os.makedirs(os.path.join(outdir,dir), exist_ok=True)
+
+    for ImType in ["space-MNI152NLin2009cAsym_desc-preproc_T1w"]:
+
+        searchIms = searchdir + '/anat/*' + ImType + '.nii.gz'
+        print(searchIms)
+
+
+        # find all Im
+        Ims = glob.glob(searchIms)
+        print(str(Ims))
+
+        for Im in Ims: 
+            # empty the MNI image, except slice 95 (AC/PC)
+            dir_name, base_name = os.path.split(os.path.splitext(os.path.splitext(Im)[0])[0])
+            output = os.path.join(outdir, dir, base_name) + '_acpc_plane.nii.gz'
+            print(output)
+            mni_img = nib.load(Im)
+            slab = acpcSlab(np.asanyarray(mni_img.dataobj))
+            nib.save(nib.Nifti1Image(slab, mni_img.affine, mni_img.header), output)
+
+            shutil.copy(Im, os.path.join(outdir,dir))
+
+            # warp that back to subject space
+            input = output
+            base_name = base_name.split('_space')[0]
+            print(base_name)
+            plane = os.path.join(outdir, dir, base_name) + '_T1w_acpc_plane.nii.gz'
+            transform = os.path.join(dir_name, base_name) + '_from-MNI152NLin2009cAsym_to-T1w_mode-image_xfm.h5'
+            reference = os.path.join(dir_name, base_name) + '_desc-preproc_T1w.nii.gz'
+            cmd = 'antsApplyTransforms -d 3 --float 1 --verbose 1' + \
+                ' -i ' + input + \
+                ' -o ' + plane + \
+                ' -r ' + reference + \
+                ' -t ' + transform + \
+                ' -n Linear'
+            print(cmd)
+            out = os.popen(cmd).read().strip()
+            print(out)
+            shutil.copy(reference, os.path.join(outdir,dir))
+
+            # the plane in subject space (only the voxels > 1 are used)
+            plane_img = nib.load(plane)
+            plane_mask = np.asanyarray(plane_img.dataobj) > 1
+            ref_shape = nib.load(reference).shape[:3]
+
+            if 0 : 
+                # intersect the DRT with the plane in subject space
+                drt = os.path.join('.','BIDS','derivatives','KUL_compute',base_name,'ses-T0','FWT', base_name + '_TCKs_output','DRT_LT_output', 'DRT_LT_fin_BT_iFOD2.tck')
+                print(drt)
+                cmd = 'cp ' + drt + ' ' + os.path.join(outdir,dir)
+                print(cmd)
+                out = os.popen(cmd).read().strip()
+                print(out)
+
+                # smooth the tract
+                drt_smooth = os.path.join(outdir, dir, base_name) + '_DRT_LT_smooth.tck'
+                cmd = 'scil_smooth_streamlines.py -f --gaussian 25 --reference ' + plane + ' ' + drt + ' ' + drt_smooth
+                out = os.popen(cmd).read().strip()
+                print(out)
+                out = os.popen(cmd).read().strip()
+                print(out)
+
+                # make a tckmap
+                drt_map = os.path.join(outdir, dir, base_name) + '_DRT_LT_smooth_map.nii.gz'
+                cmd = 'tckmap -force -contrast tdi -template ' + plane + ' ' + drt_smooth + ' ' + drt_map
+                print(cmd)
+                out = os.popen(cmd).read().strip()
+                print(out)
+
+            i = 1
+
+            for side in ['LT', 'RT']:
+
+                # extract the ac-pc plane from info file & write an image with the classical location
+                acpc_new = os.path.join(outdir, dir, base_name) + '_acpcnew_' + side + '.nii.gz'
+                classic = os.path.join(outdir, dir, base_name) + '_classic_' + side + '.nii.gz'
+                j = ods[ods['subjectid']==base_name]
+
+                if side == 'LT':
+                    xyz = [round(j.left_x.array[0]), round(j.left_y.array[0]), round(j.left_z.array[0])]
+                elif side == 'RT':
+                    xyz = [round(j.right_x.array[0]), round(j.right_y.array[0]), round(j.right_z.array[0])]
+                print(side + ' ac-pc: ' + str(xyz))
+                acpc_new_data = planeImage(ref_shape, xyz[2])
+                saveImage(acpc_new_data, plane_img, acpc_new)
+                saveImage(voxelImage(ref_shape, xyz), plane_img, classic)
+                acpc_new_mask = acpc_new_data > 1
+
+
+                for ses in ['T0','T1','T2']:
+
+                    drt = os.path.join('.','BIDS','derivatives','KUL_compute',base_name,'ses-' + ses,'FWT', base_name + \
+                        '_TCKs_output','DRT_' + side + '_output', 'DRT_' + side + '_fin_map_BT_iFOD2.nii.gz')
+                    if os.path.exists(drt):
 
-                        # make a tckmap
-                        drt_map = os.path.join(outdir, dir, base_name) + '_DRT_LT_smooth_map.nii.gz'
-                        cmd = 'tckmap -force -contrast tdi -template ' + plane + ' ' + drt_smooth + ' ' + drt_map
-                        print(cmd)
-                        out = os.popen(cmd).read().strip()
-                        print(out)
-                    
-                    i = 1
-
-                    for side in ['LT', 'RT']:
-                        
-                        # extract the ac-pc plane from info file & write an image with the classical location
-                        acpc_new = os.path.join(outdir, dir, base_name) + '_acpcnew_' + side + '.nii.gz'
-                        classic = os.path.join(outdir, dir, base_name) + '_classic_' + side + '.nii.gz'
-                        j = ods[ods['subjectid']==base_name]
-                        
-                        if side == 'LT':
-                            cmd = 'mrcalc ' + reference + ' 0 -mul - | mredit - ' + acpc_new + ' -plane 2 ' + str(round(j.left_z.array[0])) + ' 100 -force'
-                            cmd2 = 'mrcalc ' + reference + ' 0 -mul - | mredit - ' + classic + ' -voxel ' + \
-                            str(round(j.left_x.array[0])) + ',' + \
-                            str(round(j.left_y.array[0])) + ',' + \
-                            str(round(j.left_z.array[0])) \
-                            + ' 1 -force'
-                        elif side == 'RT':
-                            cmd = 'mrcalc ' + reference + ' 0 -mul - | mredit - ' + acpc_new + ' -plane 2 ' + str(round(j.right_z.array[0])) + ' 100 -force'
-                            cmd2 = 'mrcalc ' + reference + ' 0 -mul - | mredit - ' + classic + ' -voxel ' + \
-                            str(round(j.right_x.array[0])) + ',' + \
-                            str(round(j.right_y.array[0])) + ',' + \
-                            str(round(j.right_z.array[0])) \
-                            + ' 1 -force'
+                        print(drt)
+                        shutil.copy(drt, os.path.join(outdir,dir))
+
+                        # find the number of streamlines
+                        tck = os.path.join('.','BIDS','derivatives','KUL_compute',base_name,'ses-' + ses,'FWT', base_name + \
+                        '_TCKs_output','DRT_' + side + '_output', 'DRT_' + side + '_fin_BT_iFOD2.tck')
+                        count = getTckCount(tck)
+                        print(count)
+
+                        if args.tck:
+                            # where the streamlines cross the planes, no map nor regrid needed
+                            header = readTckHeader(tck)
+                            crossings = planeCrossings(readTckVertices(tck, header), plane_img.affine,
+                                [fitPlane(plane_mask), (np.array([0.0, 0.0, 1.0]), xyz[2])])
+                            for table, points, suffix in zip(['classic', 'new'], crossings, ['', '_new']):
+                                CM = centroid(points)
+                                mp = densityPeak(points)
+                                print(table + ': ' + str(len(points)) + ' crossings, CM ' + str(CM) + ', mp ' + str(mp))
+                                records.append((table, base_name, 'CM', ses, side, count) + tuple(float(c) for c in CM))
+                                records.append((table, base_name, 'mp', ses, side, count) + tuple(float(p) for p in mp))
+                                for position, name in [(CM, '_cm'), (mp, '_mp')]:
+                                    if not np.isnan(position[0]):
+                                        saveImage(markerImage(ref_shape, position, i), plane_img, \
+                                            os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
+                                            '_ses-' + ses + name + suffix + '.nii.gz')
+                            i = i + 1
+                            continue
+
+                        # regrid to HR T1W
+                        regrid = os.path.join(outdir, dir, base_name) + '_DRT_' + side + '_ses-' + ses + '_map_regrid.nii.gz'
+                        cmd = 'mrgrid -force ' + drt + ' regrid -template ' + plane + ' ' + regrid
                         print(cmd)
                         out = os.popen(cmd).read().strip()
                         print(out)
-                        print(cmd2)
-                        out = os.popen(cmd2).read().strip()
-                        print(out)
-
-
-                        for ses in ['T0','T1','T2']:
-                            
-                            drt = os.path.join('.','BIDS','derivatives','KUL_compute',base_name,'ses-' + ses,'FWT', base_name + \
-                                '_TCKs_output','DRT_' + side + '_output', 'DRT_' + side + '_fin_map_BT_iFOD2.nii.gz')
-                            if os.path.exists(drt):
-                                
-                                print(drt)
-                                cmd = 'cp ' + drt + ' ' + os.path.join(outdir,dir)
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-                                
-                                # find the number of streamlines
-                                tck = os.path.join('.','BIDS','derivatives','KUL_compute',base_name,'ses-' + ses,'FWT', base_name + \
-                                '_TCKs_output','DRT_' + side + '_output', 'DRT_' + side + '_fin_BT_iFOD2.tck')
-                                cmd = 'tckstats -output count ' + tck 
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                count = out.splitlines()[0]
-                                print(count)
-
-                                # regrid to HR T1W
-                                regrid = os.path.join(outdir, dir, base_name) + '_DRT_' + side + '_ses-' + ses + '_map_regrid.nii.gz'
-                                cmd = 'mrgrid -force ' + drt + ' regrid -template ' + plane + ' ' + regrid 
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-
-                                # make an intersection image
-                                intersect = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
-                                    '_ses-' + ses + '_map_intersect.nii.gz'
-                                cmd = 'mrcalc -force ' + plane + ' 1 -gt ' + regrid + ' -mul ' + intersect
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-
-                                # find the center of mass and write as an image
-                                img = nib.load(intersect)
-                                img_data = img.get_data()
-                                CM = ndimage.measurements.center_of_mass(img_data)
-                                print(CM)
-                                #print(round(CM[0]))
-                                cmd = 'echo "' + base_name + ', CM,' + ses + ',' + side + ',' + count + ',' + \
-                                    str(CM[0]) + ',' +  str(CM[1]) + ',' + str(CM[2]) + '" >> ' + results_csv
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-                                
-                                #print(img.header.get_data_shape())
-                                CM_image = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
-                                    '_ses-' + ses + '_cm.nii.gz'
-                                new_img_data = np.zeros(img.header.get_data_shape())
-                                new_img_data[round(CM[0]), round(CM[1]), round(CM[2])] = i
-
-                                new_img = nib.Nifti1Image(new_img_data, img.affine, img.header)
-                                nib.save(new_img, CM_image)
-                                
-
-                                # find the voxel with most streamlines
-                                mp = ndimage.measurements.maximum_position(img_data)
-                                print(mp)
-                                cmd = 'echo "' + base_name + ', mp,' + ses + ',' + side + ',' + count + ',' + \
-                                    str(mp[0]) + ',' +  str(mp[1]) + ',' + str(mp[2]) + '" >> ' + results_csv
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-
-                                mp_image = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
-                                    '_ses-' + ses + '_mp.nii.gz'
-                                new_img_data = np.zeros(img.header.get_data_shape())
-                                new_img_data[round(mp[0]), round(mp[1]), round(mp[2])] = i
-
-                                new_img = nib.Nifti1Image(new_img_data, img.affine, img.header)
-                                nib.save(new_img, mp_image)
-                                #i = i + 1
-
-                                # make an outline
-                                outline = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
-                                    '_ses-' + ses + '_map_intersect_outline.nii.gz'
-                                cmd = 'maskfilter ' + intersect + ' dilate - | mrcalc -force - ' + intersect + ' -sub ' + outline
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-
-                                # NEW #########################################
-
-                                # make an intersection image
-                                intersect = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
-                                    '_ses-' + ses + '_map_intersect_new.nii.gz'
-                                cmd = 'mrcalc -force ' + acpc_new + ' 1 -gt ' + regrid + ' -mul ' + intersect
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-
-                                # find the center of mass and write as an image
-                                img = nib.load(intersect)
-                                img_data = img.get_data()
-                                CM = ndimage.measurements.center_of_mass(img_data)
-                                print(CM)
-                                #print(round(CM[0]))
-                                cmd = 'echo "' + base_name + ', CM,' + ses + ',' + side + ',' + count + ',' + \
-                                    str(CM[0]) + ',' +  str(CM[1]) + ',' + str(CM[2]) + '" >> ' + results_csv_new
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-                                
-                                #print(img.header.get_data_shape())
-                                CM_image = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
-                                    '_ses-' + ses + '_cm_new.nii.gz'
-                                new_img_data = np.zeros(img.header.get_data_shape())
-                                new_img_data[round(CM[0]), round(CM[1]), round(CM[2])] = i
-
-                                new_img = nib.Nifti1Image(new_img_data, img.affine, img.header)
-                                nib.save(new_img, CM_image)
-                                
-
-                                # find the voxel with most streamlines
-                                mp = ndimage.measurements.maximum_position(img_data)
-                                print(mp)
-                                cmd = 'echo "' + base_name + ', mp,' + ses + ',' + side + ',' + count + ',' + \
-                                    str(mp[0]) + ',' +  str(mp[1]) + ',' + str(mp[2]) + '" >> ' + results_csv_new
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-
-                                mp_image = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
-                                    '_ses-' + ses + '_mp_new.nii.gz'
-                                new_img_data = np.zeros(img.header.get_data_shape())
-                                new_img_data[round(mp[0]), round(mp[1]), round(mp[2])] = i
-
-                                new_img = nib.Nifti1Image(new_img_data, img.affine, img.header)
-                                nib.save(new_img, mp_image)
-                                i = i + 1
-
-                                # make an outline
-                                outline = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
-                                    '_ses-' + ses + '_map_intersect_outline_new.nii.gz'
-                                cmd = 'maskfilter ' + intersect + ' dilate - | mrcalc -force - ' + intersect + ' -sub ' + outline
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-                            
-                            else: 
-                                print('No DRT found!')
-                                cmd = 'echo "' + base_name + ',' + ses + ',' + side + ',' + 'NaN,NaN, NaN, NaN" >> ' + results_csv
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-                                cmd = 'echo "' + base_name + ',' + ses + ',' + side + ',' + 'NaN,NaN, NaN, NaN" >> ' + results_csv_new
-                                print(cmd)
-                                out = os.popen(cmd).read().strip()
-                                print(out)
-                
+                        regrid = np.asanyarray(nib.load(regrid).dataobj).astype(np.float64)
+                        if regrid.ndim > 3:
+                            regrid = regrid[..., 0]
+
+                        # make an intersection image
+                        intersect = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
+                            '_ses-' + ses + '_map_intersect.nii.gz'
+                        img_data = plane_mask * regrid
+                        saveImage(img_data, plane_img, intersect)
+
+                        # find the center of mass and write as an image
+                        img = plane_img
+                        CM = ndimage.center_of_mass(img_data)
+                        print(CM)
+                        #print(round(CM[0]))
+                        records.append(('classic', base_name, 'CM', ses, side, count) + tuple(float(c) for c in CM))
+
+                        #print(img.header.get_data_shape())
+                        CM_image = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
+                            '_ses-' + ses + '_cm.nii.gz'
+                        if not np.isnan(CM[0]):
+                            saveImage(markerImage(img_data.shape, CM, i), img, CM_image)
+
+
+                        # find the voxel with most streamlines
+                        mp = ndimage.maximum_position(img_data)
+                        print(mp)
+                        records.append(('classic', base_name, 'mp', ses, side, count) + tuple(int(p) for p in mp))
+
+                        mp_image = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
+                            '_ses-' + ses + '_mp.nii.gz'
+                        saveImage(markerImage(img_data.shape, mp, i), img, mp_image)
+                        #i = i + 1
+
+                        # make an outline
+                        outline = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
+                            '_ses-' + ses + '_map_intersect_outline.nii.gz'
+                        saveImage(outlineImage(img_data), img, outline)
+
+                        # NEW #########################################
+
+                        # make an intersection image
+                        intersect = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
+                            '_ses-' + ses + '_map_intersect_new.nii.gz'
+                        img_data = acpc_new_mask * regrid
+                        saveImage(img_data, plane_img, intersect)
+
+                        # find the center of mass and write as an image
+                        CM = ndimage.center_of_mass(img_data)
+                        print(CM)
+                        #print(round(CM[0]))
+                        records.append(('new', base_name, 'CM', ses, side, count) + tuple(float(c) for c in CM))
+
+                        #print(img.header.get_data_shape())
+                        CM_image = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
+                            '_ses-' + ses + '_cm_new.nii.gz'
+                        if not np.isnan(CM[0]):
+                            saveImage(markerImage(img_data.shape, CM, i), img, CM_image)
+
+
+                        # find the voxel with most streamlines
+                        mp = ndimage.maximum_position(img_data)
+                        print(mp)
+                        records.append(('new', base_name, 'mp', ses, side, count) + tuple(int(p) for p in mp))
+
+                        mp_image = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
+                            '_ses-' + ses + '_mp_new.nii.gz'
+                        saveImage(markerImage(img_data.shape, mp, i), img, mp_image)
+                        i = i + 1
+
+                        # make an outline
+                        outline = os.path.join(outdir, dir, base_name) + '_DRT_' + side + \
+                            '_ses-' + ses + '_map_intersect_outline_new.nii.gz'
+                        saveImage(outlineImage(img_data), img, outline)
+
+                    else: 
+                        print('No DRT found!')
+                        records.append(('classic', base_name, 'NaN', ses, side, 'NaN', 'NaN', 'NaN', 'NaN'))
+                        records.append(('new', base_name, 'NaN', ses, side, 'NaN', 'NaN', 'NaN', 'NaN'))
+
+
+    return records
+
+def runSubject(root, dir):
+    # process a subject, or (with --resume) reuse its records when its inputs did not change
+    # and its outputs are still there
+    state_file = os.path.join(outdir, dir, 'DRT_state.json')
+    # the regrid method is part of it, so records of the earlier in-memory regrid are not reused
+    fingerprint = hashlib.sha1(json.dumps([args.tck, 'mrgrid regrid', getSubjectInputs(os.path.join(root, dir))]).encode()).hexdigest()
+    if args.resume and os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+        if state['fingerprint'] == fingerprint and 'outputs' in state \
+                and all(os.path.exists(output) for output in state['outputs']):
+            print(dir + ': inputs did not change, skipping')
+            return [tuple(record) for record in state['records']]
+    start = time.time()
+    records = processSubject(root, dir)
+    os.makedirs(os.path.join(outdir, dir), exist_ok=True)
+    # the outputs are the files written in the subject directory by processSubject
+    subject_dir = os.path.join(outdir, dir)
+    outputs = [os.path.join(subject_dir, f) for f in sorted(os.listdir(subject_dir))
+               if not f.startswith('DRT_state.json') and os.path.getmtime(os.path.join(subject_dir, f)) >= start]
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'records': records, 'outputs': outputs}, f)
+    os.replace(state_file + '.tmp', state_file)
+    return records
+
+# a line of the csv (without the table the record belongs to), formatted as the rows were
+# always written, e.g. "sub-X, CM,T0,LT,5000,x,y,z" or (no DRT found, without the type)
+# "sub-X,T0,LT,NaN,NaN, NaN, NaN"
+def formatRecord(record):
+    table, base_name, type, ses, side, count, x, y, z = record
+    if type == 'NaN':
+        return base_name + ',' + ses + ',' + side + ',' + 'NaN,NaN, NaN, NaN'
+    return base_name + ', ' + type + ',' + ses + ',' + side + ',' + str(count) + ',' + \
+        str(x) + ',' + str(y) + ',' + str(z)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Determine the postion of the DRT on AC-PC",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
+    parser.add_argument("-n", "--ncpu", help="number of subjects processed at the same time")
+    parser.add_argument("-t", "--tck", action="store_true", help="position from the streamlines crossing the planes instead of the DRT map")
+    parser.add_argument("-r", "--resume", action="store_true", help="skip subjects whose inputs did not change since the last run")
+    parser.add_argument("-i", "--info", help="info file with slice positions")
+    parser.add_argument("dest", help="Destination location")
+    args = parser.parse_args()
+    config = vars(args)
+    #print(config)
+
+    if args.ncpu is None:
+        ncpu = 15
+    else:
+        ncpu = int(args.ncpu)
+
+    outdir = args.dest
+    #print(outdir)
+
+    results_csv = os.path.join(outdir) + 'Results_DRT.csv'
+    results_csv_new = os.path.join(outdir) + 'Results_DRT_new.csv'
+
+    info_ods = args.info
+    ods = pd.read_excel(info_ods, engine='odf')
+    setGlobals(args, ods)
+
+    print(ods)
+    #print(ods.left_z)
+    #print(round(ods.left_z[0]))
+    basename='sub-HC10'
+    j = ods[ods['subjectid']==basename]
+    #print(j)
+    print(j.left_z.array)
+    print(str(round(j.left_z.array[0])))
+    #p=j.left_y
+    #print(p.array)
+    #print(type(p))
+    #print(p.array[0])
+    #exit()
+
+    # the subjects, in a fixed order
+    subjects = []
+    for root, dirs, files in os.walk(bidsdir):
+        for dir in dirs:
+            if 'sub-' in dir:
+                subjects.append((root, dir))
+    subjects.sort()
+
+    # process the subjects in parallel; the records come back in the order of the subjects
+    # and are written here, by the main process only
+    with ProcessPoolExecutor(max_workers=max(1, ncpu), initializer=setGlobals, initargs=(args, ods)) as pool:
+        subject_records = list(pool.map(runSubject, *zip(*subjects))) if subjects else []
+
+    for csv_file, table in [(results_csv, 'classic'), (results_csv_new, 'new')]:
+        with open(csv_file + '.tmp', 'w') as f:
+            f.write(results_header + '\n')
+            for records in subject_records:
+                for record in records:
+                    if record[0] == table:
+                        f.write(formatRecord(record) + '\n')
+        os.replace(csv_file + '.tmp', csv_file)
+
+
+if __name__ == '__main__':
+    main()